@@ -0,0 +1,383 @@
+'''Benchmarks the scrape pipeline offline by replaying a recorded corpus of pages from a local HTTP server.
+
+    python3 bench.py                            # http engine against the pages in bench_corpus/
+    python3 bench.py --engine selenium          # headless Chrome against the same pages
+    python3 bench.py --record -nb 5 -nr 30      # records a fresh corpus from amazon.com
+
+Every run prints its results and writes them to a JSON file so they can be compared between commits.
+'''
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import parsers
+from blocking import CAPTCHA, ROBOT_CHECK, THROTTLED, RetryQueue
+from checkpoint import CrawlState
+from drivers import create_chrome_driver, resolve_driver_path
+from fetcher import HttpFetcher
+from metrics import LOG_FORMAT, Metrics
+from scheduler import AsyncCrawlScheduler, RateLimiter
+from sinks import JsonLinesSink
+from web_scraper import AMAZON_BOOKS_SEARCH_URL, AmazonBooksHttpCrawler, AmazonBooksWebCrawler
+
+BENCH_SEARCH_PATH = "/s?k=best+seller+books+2022&i=stripbooks"
+
+# the pages amazon serves when it blocks us, stored in the blocked/ directory of the corpus, and their status codes
+BLOCKED_PAGES = {"captcha.html": 200, "robot_check.html": 503, "throttled.html": 503}
+
+
+def corpus_name(url):
+    '''Names the corpus file of a page: search_{page}.html, product_{asin}.html or reviews_{asin}_{page}.html'''
+    _, _, path, query, _ = urlsplit(url)
+    params = dict(parse_qsl(query))
+    asin = parsers.parse_asin(path)
+    if asin and "/product-reviews/" in path:
+        return f"reviews_{asin}_{params.get('pageNumber', 1)}.html"
+    if asin:
+        return f"product_{asin}.html"
+    if path.startswith("/s"):
+        return f"search_{params.get('page', 1)}.html"
+    return None
+
+
+class Corpus:
+    '''The recorded pages, held in memory so serving them costs nothing but the simulated latency.
+
+    A page recorded for a specific book is served for that book only. Pages without an ASIN in their name
+    (product.html, reviews_{page}.html) are served for every book, with {{ASIN}} replaced by the book's ASIN.
+    '''
+
+    def __init__(self, corpus_dir):
+        self.pages = {}
+        for name in os.listdir(corpus_dir):
+            if name.endswith(".html"):
+                with open(os.path.join(corpus_dir, name), "rb") as page_file:
+                    self.pages[name] = page_file.read()
+        self.blocked_pages = {}
+        for name in BLOCKED_PAGES:
+            path = os.path.join(corpus_dir, "blocked", name)
+            if os.path.exists(path):
+                with open(path, "rb") as page_file:
+                    self.blocked_pages[name] = page_file.read()
+
+    def page(self, url):
+        '''Returns the html of a page or None if it isn't in the corpus'''
+        name = corpus_name(url)
+        if name is None:
+            return None
+        asin = parsers.parse_asin(urlsplit(url).path)
+        candidates = [name]
+        if asin:
+            # fall back to the page shared by every book
+            candidates.append(name.replace(f"_{asin}", "") if name.startswith("reviews_") else "product.html")
+        for candidate in candidates:
+            if candidate in self.pages:
+                return self.pages[candidate].replace(b"{{ASIN}}", (asin or "").encode())
+        return None
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    '''Serves the pages of the corpus after the simulated network latency'''
+
+    def do_GET(self):
+        self.server.delay()
+        status = 200
+        body = self.server.corpus.page(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        if self.server.corpus.blocked_pages and random.random() < self.server.block_rate:
+            # pretend amazon caught us
+            name = random.choice(list(self.server.corpus.blocked_pages))
+            body, status = self.server.corpus.blocked_pages[name], BLOCKED_PAGES[name]
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # one line per request would drown the benchmark results
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    '''Local HTTP server replaying a corpus with a configurable latency per request'''
+    daemon_threads = True
+
+    def __init__(self, corpus_dir, latency=0.05, jitter=0.02, port=0, block_rate=0.0):
+        super().__init__(("127.0.0.1", port), ReplayHandler)
+        self.corpus = Corpus(corpus_dir)
+        self.latency = latency
+        self.jitter = jitter
+        # the share of requests answered with a captcha, robot check or throttling page instead
+        self.block_rate = block_rate
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def delay(self):
+        '''Sleeps for the latency of one request'''
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def start(self):
+        '''Serves requests from a background thread'''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def run_http(args, search_url, state, write, metrics):
+    '''Crawls the replayed pages with the http engine'''
+    rate_limiter = RateLimiter(rate=args.rate, burst=args.concurrency, jitter=0)
+    crawler = AmazonBooksHttpCrawler(HttpFetcher(pool_size=args.concurrency + 1), url=search_url,
+                                     rate_limiter=rate_limiter, state=state, metrics=metrics,
+                                     retries=RetryQueue(base_delay=args.block_backoff))
+    try:
+        write(AsyncCrawlScheduler(crawler, args.concurrency).run(args.num_books, args.num_reviews))
+    finally:
+        crawler.quit()
+
+
+def run_selenium(args, search_url, state, write, metrics):
+    '''Crawls the replayed pages with headless Chrome like web_scraper.py does'''
+    driver = create_chrome_driver(args.driver_path, headless=True)
+    rate_limiter = RateLimiter(rate=args.rate, burst=args.concurrency, jitter=0)
+    crawler = AmazonBooksWebCrawler(driver, extraction=args.extraction, url=search_url, state=state,
+                                    rate_limiter=rate_limiter, metrics=metrics,
+                                    retries=RetryQueue(base_delay=args.block_backoff))
+    try:
+        write(crawler.get_books_and_reviews(args.num_books, args.num_reviews))
+        while crawler.has_next_book_page() and state.count_books() < args.num_books:
+            if not crawler.go_to_next_book_page():
+                break
+            crawler.scroll_to_bottom()
+            # only the books left to reach -nb are scraped from the page
+            write(crawler.get_books_and_reviews(args.num_books - state.count_books(), args.num_reviews))
+        write(crawler.get_blocked_reviews(wait=True))
+    finally:
+        crawler.quit()
+
+
+def current_commit():
+    '''Returns the commit being benchmarked, or None outside of a git checkout'''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    '''Runs one crawl against the replay server and returns its results'''
+    server = ReplayServer(args.corpus, latency=args.latency, jitter=args.latency_jitter, port=args.port,
+                          block_rate=args.block_rate).start()
+    if args.engine == "selenium" and args.driver_path is None:
+        # resolved before the clock starts so the driver download isn't part of the results
+        args.driver_path = resolve_driver_path()
+
+    # the crawlers time fetching, parsing and the browser themselves, we add checkpointing and writing
+    metrics = Metrics()
+    for name in ["get_book", "add_book", "count_reviews", "add_review_page", "finish_book", "count_books",
+                 "set_meta"]:
+        metrics.wrap(CrawlState, name, "checkpoint")
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as work_dir:
+        state = CrawlState(os.path.join(work_dir, "crawl_state.db"))
+        sink = JsonLinesSink(work_dir, work_dir)
+
+        def write(records):
+            for kind, record in records:
+                if kind != "checkpoint":
+                    metrics.incr("books" if kind == "book" else "reviews")
+                with metrics.timer("write"):
+                    sink.write(kind, record)
+
+        started_at = time.perf_counter()
+        try:
+            if args.engine == "http":
+                run_http(args, server.url + BENCH_SEARCH_PATH, state, write, metrics)
+            else:
+                run_selenium(args, server.url + BENCH_SEARCH_PATH, state, write, metrics)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            # the last checkpoints are made once the sink is flushed
+            sink.close()
+            # books whose reviews were still blocked when the run gave up on them
+            unfinished_books = state.count_books() - state.count_books(finished_only=True)
+            state.close()
+            server.shutdown()
+            server.server_close()
+
+    data = metrics.snapshot()
+    pages = data["counters"].get("pages", 0)
+    reviews = data["counters"].get("reviews", 0)
+    round_trips = data["stages"].get("webdriver", {}).get("count", 0)
+    requests = data["counters"].get("requests", 0)
+    # ru_maxrss is in kilobytes on linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_children_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {
+        "commit": current_commit(),
+        "engine": args.engine,
+        "extraction": args.extraction if args.engine == "selenium" else "snapshot",
+        "config": {
+            "num_books": args.num_books,
+            "num_reviews": args.num_reviews,
+            "concurrency": args.concurrency,
+            "latency": args.latency,
+            "latency_jitter": args.latency_jitter,
+            "rate": args.rate,
+            "block_rate": args.block_rate,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "pages": pages,
+        "books": data["counters"].get("books", 0),
+        "reviews": reviews,
+        "pages_per_s": round(pages / elapsed, 2),
+        "reviews_per_s": round(reviews / elapsed, 2),
+        "webdriver_round_trips": round_trips,
+        "round_trips_per_page": round(round_trips / pages, 2) if pages else 0,
+        "blocked": {kind: data["counters"].get(f"blocked_{kind}", 0) for kind in [CAPTCHA, ROBOT_CHECK, THROTTLED]},
+        "block_rate": round(data["counters"].get("blocked", 0) / requests, 4) if requests else 0,
+        "session_rotations": data["counters"].get("session_rotations", 0),
+        "unfinished_books": unfinished_books,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "peak_children_rss_mb": round(peak_children_rss_mb, 1),
+        # stages running in several threads at once add up the time of every thread
+        "stages": {stage: {"seconds": round(histogram["sum"], 4), "calls": histogram["count"]}
+                   for stage, histogram in sorted(data["stages"].items())},
+    }
+
+
+class RecordingFetcher(HttpFetcher):
+    '''Saves every page it fetches to the corpus under its corpus_name'''
+
+    def __init__(self, corpus_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.corpus_dir = corpus_dir
+
+    def get(self, url, before_request=None):
+        final_url, page_source = super().get(url, before_request)
+        name = corpus_name(url)
+        if name is not None:
+            with open(os.path.join(self.corpus_dir, name), "w", encoding="utf-8") as page_file:
+                page_file.write(page_source)
+        return final_url, page_source
+
+
+def record(args):
+    '''Crawls amazon.com politely with the http engine and saves every page it fetches to the corpus'''
+    os.makedirs(args.corpus, exist_ok=True)
+    crawler = AmazonBooksHttpCrawler(RecordingFetcher(args.corpus), url=AMAZON_BOOKS_SEARCH_URL,
+                                     rate_limiter=RateLimiter(rate=0.5, jitter=1.0, min_rate=0.05))
+    try:
+        for _ in AsyncCrawlScheduler(crawler, concurrency=1).run(args.num_books, args.num_reviews):
+            pass
+    finally:
+        crawler.quit()
+    print(f"Recorded {crawler.stats.pages} pages to {args.corpus}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmarks the scraper against recorded pages replayed by a local server")
+    parser.add_argument("--corpus",
+                        dest="corpus",
+                        help="Directory of recorded pages (default: bench_corpus)",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_corpus"))
+    parser.add_argument("--engine",
+                        dest="engine",
+                        help="Engine to benchmark (default: http)",
+                        choices=["http", "selenium"],
+                        default="http")
+    parser.add_argument("--extraction",
+                        dest="extraction",
+                        help="Extraction used by the selenium engine (default: snapshot)",
+                        choices=["snapshot", "selenium"],
+                        default="snapshot")
+    parser.add_argument("-nb",
+                        "--num-books",
+                        dest="num_books",
+                        help="Maximum number of books to scrape (default: 48)",
+                        type=int,
+                        default=48)
+    parser.add_argument("-nr",
+                        "--num-reviews",
+                        dest="num_reviews",
+                        help="Maximum number of reviews to scrape for each book (default: 30)",
+                        type=int,
+                        default=30)
+    parser.add_argument("--concurrency",
+                        dest="concurrency",
+                        help="Number of books whose reviews are fetched at the same time by the http engine (default: 4)",
+                        type=int,
+                        default=4)
+    parser.add_argument("--rate",
+                        dest="rate",
+                        help="Rate limit of the http engine in pages per second, high enough not to matter by default "
+                             "(default: 1000)",
+                        type=float,
+                        default=1000)
+    parser.add_argument("--latency",
+                        dest="latency",
+                        help="Seconds the replay server waits before answering each request (default: 0.05)",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--latency-jitter",
+                        dest="latency_jitter",
+                        help="Maximum random seconds added to or taken from the latency (default: 0.02)",
+                        type=float,
+                        default=0.02)
+    parser.add_argument("--block-rate",
+                        dest="block_rate",
+                        help="Share of requests the replay server answers with one of the captcha, robot check or "
+                             "throttling pages stored in the corpus's blocked/ directory (default: 0)",
+                        type=float,
+                        default=0.0)
+    parser.add_argument("--block-backoff",
+                        dest="block_backoff",
+                        help="Seconds before the first retry of a blocked page, short so blocks don't dominate the "
+                             "timings (default: 0.05)",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--port",
+                        dest="port",
+                        help="Port of the replay server (default: any free port)",
+                        type=int,
+                        default=0)
+    parser.add_argument("--driver-path",
+                        dest="driver_path",
+                        help="chromedriver to use for the selenium engine (default: resolved by webdriver_manager)",
+                        default=None)
+    parser.add_argument("--output",
+                        dest="output",
+                        help="JSON file the results are written to (default: bench_results.json)",
+                        default="bench_results.json")
+    parser.add_argument("--verbose",
+                        dest="verbose",
+                        help="Show the crawler's progress messages",
+                        action="store_true")
+    parser.add_argument("--record",
+                        dest="record",
+                        help="Record a new corpus from amazon.com into --corpus instead of running the benchmark",
+                        action="store_true")
+
+    args = parser.parse_args()
+    # the crawler's progress messages would bury the results
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format=LOG_FORMAT)
+    if args.record:
+        record(args)
+    else:
+        results = benchmark(args)
+        with open(args.output, "w", encoding="utf-8") as results_file:
+            json.dump(results, results_file, indent=2)
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,163 @@
+'''Tells when amazon blocks the crawl, and holds what it blocked until it can be tried again from a fresh session'''
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+
+# what a page can turn out to be
+OK = "ok"
+CAPTCHA = "captcha"
+ROBOT_CHECK = "robot_check"
+THROTTLED = "throttled"
+DESCRIPTIONS = {CAPTCHA: "a captcha", ROBOT_CHECK: "a robot check", THROTTLED: "a throttling page"}
+
+# a captcha we could solve, a robot check telling us to go away and the page served when we simply go too fast.
+# the robot check text also appears on captcha pages so the captcha is looked for first
+CAPTCHA_PAGE = re.compile(r"/errors/validateCaptcha|id=\"captchacharacters\"|Enter the characters you see below",
+                          re.IGNORECASE)
+ROBOT_CHECK_PAGE = re.compile(r"make sure you're not a robot|automated access to Amazon data", re.IGNORECASE)
+THROTTLED_PAGE = re.compile(r"Request was throttled", re.IGNORECASE)
+THROTTLED_STATUSES = {429, 503}
+# the pages amazon blocks us with are a few kilobytes while the books and reviews pages are much bigger. the text of
+# the block pages is only looked for in small pages, so a review quoting "make sure you're not a robot" doesn't make
+# its page look blocked
+MAX_BLOCK_PAGE_SIZE = 20000
+
+# user agents of recent desktop browsers, a new session takes the next one
+USER_AGENTS = [
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 "
+    "Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:127.0) Gecko/20100101 Firefox/127.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 "
+    "Safari/605.1.15",
+]
+_user_agents = itertools.cycle(USER_AGENTS)
+_user_agents_lock = threading.Lock()
+
+
+def next_user_agent():
+    '''Returns the user agent of the next session'''
+    with _user_agents_lock:
+        return next(_user_agents)
+
+
+def classify_page(page_source, status_code=200):
+    '''Tells whether a page is the one we asked for (OK) or amazon blocking us with a CAPTCHA, a ROBOT_CHECK or
+    because we are THROTTLED'''
+    if len(page_source) < MAX_BLOCK_PAGE_SIZE:
+        if CAPTCHA_PAGE.search(page_source):
+            return CAPTCHA
+        if ROBOT_CHECK_PAGE.search(page_source):
+            return ROBOT_CHECK
+        if THROTTLED_PAGE.search(page_source):
+            return THROTTLED
+    if status_code in THROTTLED_STATUSES:
+        return THROTTLED
+    return OK
+
+
+class PageBlocked(Exception):
+    '''Raised when amazon serves a captcha, a robot check or a throttling page instead of the page we asked for'''
+
+    def __init__(self, url, kind):
+        super().__init__(f"Amazon served {DESCRIPTIONS[kind]} instead of {url}")
+        self.url = url
+        self.kind = kind
+
+
+class BlockTracker:
+    '''Counts how many of the pages amazon served were blocked, so the rate can be pushed as far as it goes without
+    losing pages, and tells when a session was blocked too many times in a row and should be replaced'''
+
+    def __init__(self, metrics, rotate_after=3):
+        self.metrics = metrics
+        self.rotate_after = rotate_after
+        self.consecutive = 0
+        self.lock = threading.Lock()
+
+    def ok(self):
+        '''Records a page that went through'''
+        self.metrics.incr("requests")
+        with self.lock:
+            self.consecutive = 0
+
+    def blocked(self, kind):
+        '''Records a blocked page. Returns whether the session should be rotated now'''
+        self.metrics.incr("requests")
+        self.metrics.incr("blocked")
+        self.metrics.incr(f"blocked_{kind}")
+        with self.lock:
+            self.consecutive += 1
+            if self.consecutive < self.rotate_after:
+                return False
+            self.consecutive = 0
+        self.metrics.incr("session_rotations")
+        return True
+
+    def report(self):
+        '''Returns a one line summary of how often we were blocked'''
+        requests = self.metrics.count("requests")
+        blocked = self.metrics.count("blocked")
+        block_rate = blocked / requests if requests else 0
+        return (f"Blocked {blocked} of {requests} pages ({block_rate:.1%}): "
+                f"{self.metrics.count('blocked_' + CAPTCHA)} captchas, "
+                f"{self.metrics.count('blocked_' + ROBOT_CHECK)} robot checks, "
+                f"{self.metrics.count('blocked_' + THROTTLED)} throttled, "
+                f"{self.metrics.count('session_rotations')} session rotations")
+
+
+class RetryQueue:
+    '''Jobs that were blocked, each waiting out an exponential backoff before it is tried again. A job is given up
+    on after max_attempts retries'''
+
+    def __init__(self, base_delay=30, max_delay=900, max_attempts=5):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        # (due time, insertion order, job) so jobs due at the same time come back in the order they were blocked
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def backoff(self, attempt):
+        '''Returns how long to wait before a given retry: the delay doubles with every attempt and is randomized
+        so blocked jobs don't all come back at once'''
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def push(self, key, job):
+        '''Schedules a blocked job to be tried again. Returns how long it will wait, or None when it was already
+        retried max_attempts times'''
+        with self.lock:
+            attempt = self.attempts.get(key, 0) + 1
+            if attempt > self.max_attempts:
+                return None
+            self.attempts[key] = attempt
+            delay = self.backoff(attempt)
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), job))
+        return delay
+
+    def pop_ready(self):
+        '''Returns the jobs whose backoff is over'''
+        ready = []
+        with self.lock:
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                ready.append(heapq.heappop(self.heap)[2])
+        return ready
+
+    def wait_time(self):
+        '''Returns how many seconds until the next job is due, or None if there is none'''
+        with self.lock:
+            if not self.heap:
+                return None
+            return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
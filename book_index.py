@@ -0,0 +1,82 @@
+'''Remembers every book scraped by earlier crawls, so books keep their ID from one crawl to the next and books
+scraped recently are skipped'''
+import time
+
+from records import Book
+from sqlitestore import open_sqlite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    book_key TEXT UNIQUE NOT NULL,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_scraped REAL
+);
+CREATE TABLE IF NOT EXISTS book_history (
+    book_id INTEGER NOT NULL,
+    scraped_at REAL NOT NULL,
+    price REAL,
+    ratings REAL,
+    num_reviews INTEGER
+);
+CREATE INDEX IF NOT EXISTS book_history_book_id ON book_history (book_id, scraped_at);
+"""
+
+
+class BookIndex:
+    '''SQLite index of the books of every crawl, kept across crawls.
+
+    Books are identified by their book_key (their ASIN if they have one). A book gets its ID the first time it is
+    seen and keeps it in every later crawl. Every time a book is scraped again its price, ratings and number of
+    reviews are added to its history, and once all its reviews are scraped the time is kept so later crawls can
+    skip it until it is refresh_after seconds old.
+    '''
+
+    def __init__(self, path, refresh_after=24 * 60 * 60):
+        self.path = path
+        self.refresh_after = refresh_after
+        self.connection, self.lock = open_sqlite(path, SCHEMA)
+
+    def recently_scraped(self, book_key):
+        '''Returns the ID of a book if an earlier crawl scraped it less than refresh_after seconds ago, None if it
+        needs scraping'''
+        with self.lock:
+            row = self.connection.execute("SELECT id, last_scraped FROM books WHERE book_key = ?",
+                                          (book_key,)).fetchone()
+        if row is None or row[1] is None or time.time() - row[1] >= self.refresh_after:
+            return None
+        return row[0]
+
+    def new_book(self, book_key, book_card):
+        '''Turns the fields of a book card into a book with the ID it got when it was first seen, or a new stable ID,
+        and adds its price, ratings and number of reviews to its history'''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO books (book_key, title, authors, first_seen) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (book_key) DO UPDATE SET title = excluded.title, authors = excluded.authors",
+                (book_key, book_card["title"], book_card["authors"], now))
+            book_id, = self.connection.execute("SELECT id FROM books WHERE book_key = ?", (book_key,)).fetchone()
+            self.connection.execute(
+                "INSERT INTO book_history (book_id, scraped_at, price, ratings, num_reviews) VALUES (?, ?, ?, ?, ?)",
+                (book_id, now, book_card["price"], book_card["ratings"], book_card["num_reviews"]))
+        return Book(book_id, book_card["title"], book_card["authors"], book_card["price"], book_card["ratings"],
+                    book_card["num_reviews"])
+
+    def finish_book(self, book_id):
+        '''Keeps the time a book was scraped, with all its reviews'''
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE books SET last_scraped = ? WHERE id = ?", (time.time(), book_id))
+
+    def history(self, book_id):
+        '''Returns the (scraped_at, price, ratings, num_reviews) of every crawl that scraped a book, oldest first'''
+        with self.lock:
+            return self.connection.execute(
+                "SELECT scraped_at, price, ratings, num_reviews FROM book_history WHERE book_id = ? "
+                "ORDER BY scraped_at", (book_id,)).fetchall()
+
+    def close(self):
+        '''Closes the index'''
+        self.connection.close()
@@ -0,0 +1,187 @@
+'''Keeps the progress of a crawl on disk so an interrupted run can be resumed'''
+import json
+
+import parsers
+from records import Book
+from sqlitestore import open_sqlite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    data TEXT NOT NULL,
+    reviews_url TEXT,
+    written INTEGER NOT NULL DEFAULT 0,
+    reviews_done INTEGER NOT NULL DEFAULT 0,
+    reviews_saved INTEGER NOT NULL DEFAULT 0,
+    last_review_page_url TEXT
+);
+CREATE TABLE IF NOT EXISTS book_queries (
+    book_id INTEGER NOT NULL,
+    query TEXT NOT NULL,
+    PRIMARY KEY (book_id, query)
+);
+"""
+
+
+class CrawlState:
+    '''SQLite store of the search page being crawled, the books found so far and how far their reviews got.
+
+    Every change is a small insert or update committed on its own, so checkpoints stay cheap no matter how big
+    the crawl gets.
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.connection, self.lock = open_sqlite(path, SCHEMA)
+        # keys of the books started by this run, so a book listed on several search pages is only scraped once
+        self.started = set()
+        if not resume:
+            # starting over so we forget anything left by a previous run
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM meta")
+                self.connection.execute("DELETE FROM books")
+                self.connection.execute("DELETE FROM book_queries")
+
+    def get_meta(self, key, default=None):
+        '''Reads a value saved with set_meta'''
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        '''Saves a small value such as the url of the current search page or an ID counter'''
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_book(self, key):
+        '''Returns the saved book for a key, whether it was written out, whether its reviews are done and the last
+        review page scraped'''
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data, written, reviews_done, last_review_page_url FROM books WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        data, written, reviews_done, last_review_page_url = row
+        return Book.from_dict(json.loads(data)), bool(written), bool(reviews_done), last_review_page_url
+
+    def add_book(self, key, book, reviews_url, next_book_id):
+        '''Saves a newly found book and the link to its reviews together with the book ID counter'''
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO books (id, key, data, reviews_url) VALUES (?, ?, ?, ?)",
+                                    (book.id, key, json.dumps(book.to_dict()), reviews_url))
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_book_id', ?)",
+                                    (json.dumps(next_book_id),))
+
+    def unfinished_books(self):
+        '''Returns the key, book, link to its reviews, whether it was written out and the last review page scraped
+        of every saved book whose reviews aren't done, in the order they were found'''
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, data, reviews_url, written, last_review_page_url FROM books WHERE reviews_done = 0 "
+                "ORDER BY id").fetchall()
+        return [(key, Book.from_dict(json.loads(data)), reviews_url, bool(written), last_review_page_url)
+                for key, data, reviews_url, written, last_review_page_url in rows]
+
+    def book_written(self, book_id):
+        '''Marks a book as written out so a resumed run doesn't write it again'''
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE books SET written = 1 WHERE id = ?", (book_id,))
+
+    def count_reviews(self, book_id):
+        '''Returns how many reviews are saved for a book'''
+        with self.lock:
+            row = self.connection.execute("SELECT reviews_saved FROM books WHERE id = ?", (book_id,)).fetchone()
+        return row[0] if row else 0
+
+    def add_review_page(self, book_id, num_reviews, page_url):
+        '''Counts the reviews scraped from one page of a book's reviews and remembers the page they came from, unless
+        the page isn't known. The reviews themselves are in the output files, a resumed run only needs to know how
+        many a book has'''
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE books SET reviews_saved = reviews_saved + ?, "
+                "last_review_page_url = COALESCE(?, last_review_page_url) WHERE id = ?",
+                (num_reviews, page_url, book_id))
+
+    def has_book_query(self, book_id, query):
+        '''Checks whether the run this one resumes already saved that a search listed a book'''
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM book_queries WHERE book_id = ? AND query = ?",
+                                           (book_id, query)).fetchone() is not None
+
+    def add_book_query(self, book_id, query):
+        '''Saves that a search listed a book'''
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO book_queries (book_id, query) VALUES (?, ?)",
+                                    (book_id, query))
+
+    def finish_book(self, book_id):
+        '''Marks the reviews of a book as done so a resumed run skips it'''
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE books SET reviews_done = 1 WHERE id = ?", (book_id,))
+
+    def count_books(self, finished_only=False):
+        '''Returns how many books are saved, or only how many have all their reviews'''
+        query = "SELECT COUNT(*) FROM books WHERE reviews_done = 1" if finished_only else "SELECT COUNT(*) FROM books"
+        with self.lock:
+            return self.connection.execute(query).fetchone()[0]
+
+    def close(self):
+        '''Closes the database'''
+        self.connection.close()
+
+
+def book_key(book_card):
+    '''Identifies a book across runs by the ASIN in its reviews link, or by its title and authors if it has none'''
+    asin = parsers.parse_asin(book_card["reviews_url"] or "")
+    return asin or f"{book_card['title']}|{book_card['authors']}"
+
+
+def start_or_resume_book(state, book_card, new_book):
+    '''Returns the book for a card, the last review page scraped for it and whether it was started by a previous
+    run, or None if the book is already done'''
+    if state is None:
+        return new_book(book_card), None, False
+
+    key = book_key(book_card)
+    if key in state.started:
+        return None
+    state.started.add(key)
+
+    saved = state.get_book(key)
+    if saved is None:
+        book = new_book(book_card)
+        state.add_book(key, book, book_card["reviews_url"], book.id + 1)
+        return book, None, False
+
+    book, written, reviews_done, last_review_page_url = saved
+    if reviews_done:
+        return None
+    return resume_book(book, written, last_review_page_url)
+
+
+def resume_book(book, written, last_review_page_url):
+    '''Returns an unfinished book saved by a previous run, the last review page scraped for it and whether it was
+    started by that run'''
+    if not written:
+        # the interrupted run stopped before the book was written out, and so before any of its reviews were. it
+        # starts over with the ID it was given
+        return book, None, False
+    return book, last_review_page_url, True
+
+
+def resume_unfinished_books(state):
+    '''Yields the card, book, last review page scraped and whether it was started by a previous run of every book
+    the run this one resumes left unfinished, like start_or_resume_book. The books are on the pages of results
+    before the one it got to, so they are picked up before paging carries on'''
+    for key, book, reviews_url, written, last_review_page_url in state.unfinished_books():
+        if key in state.started:
+            continue
+        state.started.add(key)
+        book_card = {"title": book.title, "authors": book.authors, "reviews_url": reviews_url}
+        yield (book_card, *resume_book(book, written, last_review_page_url))
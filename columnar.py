@@ -0,0 +1,244 @@
+'''Writes books and reviews as typed, columnar Parquet files and converts existing CSV outputs to them.
+
+Requires pyarrow (pip install pyarrow).
+'''
+import csv
+import glob
+import os
+import shutil
+import uuid
+from argparse import ArgumentParser
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from records import Record
+from sinks import Sink
+
+BOOKS_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("title", pa.string()),
+    ("authors", pa.string()),
+    ("price", pa.float64()),
+    ("ratings", pa.float64()),
+    ("num_reviews", pa.int64()),
+])
+
+REVIEWS_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("book_id", pa.int64()),
+    ("title", pa.string()),
+    # only a handful of distinct locations are repeated across every review
+    ("location", pa.dictionary(pa.int32(), pa.string())),
+    ("reviewed_on", pa.date32()),
+    ("rating", pa.float64()),
+    ("body", pa.string()),
+    ("num_helpful_votes", pa.int64()),
+])
+
+BOOK_QUERIES_SCHEMA = pa.schema([
+    ("book_id", pa.int64()),
+    # every search lists many books
+    ("query", pa.dictionary(pa.int32(), pa.string())),
+])
+
+REVIEWS_PARTITIONING = ds.partitioning(pa.schema([("book_id", pa.int64())]), flavor="hive")
+
+
+def to_int(value):
+    '''Converts a scraped value (or its csv text) to an int, None when missing'''
+    return None if value is None or value == "" else int(value)
+
+
+def to_float(value):
+    '''Converts a scraped value (or its csv text) to a float, None when missing'''
+    return None if value is None or value == "" else float(value)
+
+
+def to_date(value):
+    '''Parses a review date such as "March 3, 2023", None when missing or in another format'''
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%B %d, %Y").date()
+    except ValueError:
+        return None
+
+
+BOOK_COLUMNS = {
+    "id": to_int,
+    "title": str,
+    "authors": str,
+    "price": to_float,
+    "ratings": to_float,
+    "num_reviews": to_int,
+}
+
+REVIEW_COLUMNS = {
+    "id": to_int,
+    "book_id": to_int,
+    "title": str,
+    "location": str,
+    "reviewed_on": to_date,
+    "rating": to_float,
+    "body": str,
+    "num_helpful_votes": to_int,
+}
+
+BOOK_QUERY_COLUMNS = {
+    "book_id": to_int,
+    "query": str,
+}
+
+
+class ColumnBatch:
+    '''Collects rows column by column, converting every value to its column type'''
+
+    def __init__(self, columns, schema):
+        self.columns = columns
+        self.schema = schema
+        self.clear()
+
+    def clear(self):
+        '''Empties the batch once it has been written'''
+        self.values = {name: [] for name in self.columns}
+
+    def __len__(self):
+        # every column has a value for every row
+        return len(self.values[next(iter(self.columns))])
+
+    def append(self, record):
+        '''Adds a book or review, either as scraped or as read back from a csv file'''
+        if isinstance(record, Record):
+            record = record.to_dict()
+        for name, convert in self.columns.items():
+            value = record.get(name)
+            self.values[name].append(None if value is None else convert(value))
+
+    def to_table(self):
+        '''Returns the batch as an arrow table with the column types of the schema'''
+        return pa.table(self.values, schema=self.schema)
+
+
+class ParquetSink(Sink):
+    '''Writes books to a books.parquet dataset and reviews to a reviews.parquet dataset partitioned by book_id, and
+    the searches that listed every book to a book_queries.parquet dataset.
+
+    Rows are buffered and written one row group at a time so memory stays bounded however big the crawl is. Every
+    batch becomes a new file in the dataset, so a resumed crawl adds to the datasets of the interrupted one. Unless
+    we are appending to them the datasets are emptied first.
+    '''
+
+    def __init__(self, books_path, reviews_path, row_group_size=10000, book_queries_path=None, append=False,
+                 checkpointed=True):
+        # rows are written a row group at a time so there is nothing for the base class to flush. the checkpoints
+        # wait until a row group is written
+        super().__init__(flush_every=None, checkpointed=checkpointed)
+        self.books_path = books_path
+        self.reviews_path = reviews_path
+        # which searches listed every book goes next to the books by default
+        self.book_queries_path = book_queries_path or os.path.join(os.path.dirname(books_path), "book_queries.parquet")
+        self.row_group_size = row_group_size
+        self.books = ColumnBatch(BOOK_COLUMNS, BOOKS_SCHEMA)
+        self.reviews = ColumnBatch(REVIEW_COLUMNS, REVIEWS_SCHEMA)
+        self.book_queries = ColumnBatch(BOOK_QUERY_COLUMNS, BOOK_QUERIES_SCHEMA)
+        if not append:
+            # starting over so the files of an earlier run don't get mixed with ours
+            for path in [self.books_path, self.reviews_path, self.book_queries_path]:
+                shutil.rmtree(path, ignore_errors=True)
+
+        # file names start with an ID of the sink so they never clash with those of an earlier run, or of another
+        # sink writing to the same datasets
+        self.run = uuid.uuid4().hex
+        self.num_batches = 0
+
+    def write_book(self, book):
+        self.books.append(book)
+        if len(self.books) >= self.row_group_size:
+            self.sync()
+
+    def write_review(self, review):
+        self.reviews.append(review)
+        if len(self.reviews) >= self.row_group_size:
+            # the reviews of a book arrive together so a batch usually adds one file to a few partitions. the books
+            # and listings buffered so far are written with it so the checkpoints of everything before can be made
+            self.sync()
+
+    def write_book_query(self, book_query):
+        self.book_queries.append(book_query)
+        if len(self.book_queries) >= self.row_group_size:
+            self.sync()
+
+    def write_batch(self, batch, path, partitioning=None):
+        '''Writes the buffered rows of a batch as new files of a dataset'''
+        if len(batch):
+            ds.write_dataset(batch.to_table(),
+                             path,
+                             format="parquet",
+                             partitioning=partitioning,
+                             basename_template=f"part-{self.run}-{self.num_batches}-{{i}}.parquet",
+                             existing_data_behavior="overwrite_or_ignore")
+            self.num_batches += 1
+            batch.clear()
+
+    def flush(self):
+        self.write_batch(self.books, self.books_path)
+        self.write_batch(self.reviews, self.reviews_path, REVIEWS_PARTITIONING)
+        self.write_batch(self.book_queries, self.book_queries_path)
+
+
+def read_csv_rows(paths):
+    '''Yields the rows of several csv files one at a time'''
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as csv_file:
+            yield from csv.DictReader(csv_file)
+
+
+def convert_csv_outputs(books_dir, reviews_dir, output_dir, row_group_size=10000):
+    '''Converts the books.csv, book_queries.csv and review csv files written by a crawl to books.parquet,
+    book_queries.parquet and reviews.parquet'''
+    sink = ParquetSink(os.path.join(output_dir, "books.parquet"), os.path.join(output_dir, "reviews.parquet"),
+                       row_group_size, book_queries_path=os.path.join(output_dir, "book_queries.parquet"),
+                       checkpointed=False)
+    try:
+        for book in read_csv_rows([os.path.join(books_dir, "books.csv")]):
+            sink.write("book", book)
+
+        # crawls made before searches were mapped to their books have no book_queries.csv
+        for book_query in read_csv_rows(glob.glob(os.path.join(books_dir, "book_queries.csv"))):
+            sink.write("book_query", book_query)
+
+        # reviews may be in one file per book or all in reviews.csv, in which case there is a single file to read
+        review_paths = sorted(glob.glob(os.path.join(reviews_dir, "book_*_reviews.csv")),
+                              key=lambda path: int(os.path.basename(path).split("_")[1]))
+        review_paths += glob.glob(os.path.join(reviews_dir, "reviews.csv"))
+        for review in read_csv_rows(review_paths):
+            sink.write("review", review)
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Converts the csv files written by web_scraper.py to Parquet")
+    parser.add_argument("--books-dir",
+                        dest="books_dir",
+                        help="Directory containing books.csv and book_queries.csv (default: books)",
+                        default="books")
+    parser.add_argument("--reviews-dir",
+                        dest="reviews_dir",
+                        help="Directory containing the review csv files (default: reviews)",
+                        default="reviews")
+    parser.add_argument("--output-dir",
+                        dest="output_dir",
+                        help="Directory where books.parquet, book_queries.parquet and reviews.parquet are written "
+                             "(default: .)",
+                        default=".")
+    parser.add_argument("--row-group-size",
+                        dest="row_group_size",
+                        help="Number of rows written at a time (default: 10000)",
+                        type=int,
+                        default=10000)
+
+    args = parser.parse_args()
+    convert_csv_outputs(args.books_dir, args.reviews_dir, args.output_dir, args.row_group_size)
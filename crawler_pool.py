@@ -0,0 +1,280 @@
+'''Scrapes the reviews of many books in parallel with a pool of headless Chrome workers'''
+import logging
+import multiprocessing
+import queue
+import shutil
+import tempfile
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from blocking import PageBlocked, RetryQueue, next_user_agent
+from drivers import create_chrome_driver, is_driver_alive, quit_driver
+from metrics import LOG_FORMAT, Metrics
+
+logger = logging.getLogger(__name__)
+
+
+def review_worker(worker_id, jobs, results, driver_path, profile_dir, extraction, log_level, rate_limits,
+                  wait_timeout, rotate_after, block_resources=True):
+    '''Runs in a worker process, scraping the reviews of one book at a time until it is told to stop'''
+    # imported here so the worker process doesn't need the pool's parent module to be importable first
+    from scheduler import RateLimiter
+    from web_scraper import AmazonBooksWebCrawler
+
+    # a spawned process starts without the parent's logging setup
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    # the metrics of every job are sent back with its reviews and merged into the parent's
+    metrics = Metrics()
+    # every worker is its own browser session so it keeps its own share of the rate, which slows down when amazon
+    # pushes back
+    rate_limiter = RateLimiter(**rate_limits)
+    # the first browser uses chrome's own user agent, the ones replacing a blocked browser take a new one each
+    user_agent = None
+    crawler = None
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                # the parent is shutting the pool down
+                break
+
+            book_id, reviews_url, max_num_reviews, last_review_page_url, known = job
+            results.put(("started", worker_id, book_id))
+
+            # check the browser is healthy before every job and start a fresh one if it crashed
+            if crawler is not None and not is_driver_alive(crawler.driver):
+                logger.warning("Worker %s: browser stopped responding, restarting it...", worker_id)
+                quit_driver(crawler.driver)
+                crawler = None
+            if crawler is None:
+                driver = create_chrome_driver(driver_path, headless=True, profile_dir=profile_dir,
+                                              user_agent=user_agent, block_resources=block_resources)
+                crawler = AmazonBooksWebCrawler(driver, extraction=extraction, url=None, rate_limiter=rate_limiter,
+                                                wait_timeout=wait_timeout, metrics=metrics, rotate_after=rotate_after)
+
+            reviews = []
+            try:
+                # a book resumed from a previous run carries on after the last page of reviews it saved
+                resume = last_review_page_url is not None
+                crawler.load(last_review_page_url if resume else reviews_url)
+                for page_reviews in crawler.collect_book_reviews(max_num_reviews, resume, known):
+                    reviews += page_reviews
+            except PageBlocked as blocked:
+                # the parent puts the book back in the queue once its backoff is over
+                logger.warning("Worker %s: %s", worker_id, blocked)
+                if crawler.rotate_pending:
+                    # blocked too many times in a row so the next job starts a new browser with new cookies
+                    logger.warning("Worker %s: starting a new browser", worker_id)
+                    quit_driver(crawler.driver)
+                    crawler = None
+                    user_agent = next_user_agent()
+                results.put(("blocked", worker_id, book_id, blocked.kind, metrics.snapshot(reset=True)))
+                continue
+            except Exception as e:
+                # a page that was too slow is only a timeout, any other error from the browser means it crashed
+                if (isinstance(e, WebDriverException) and not isinstance(e, TimeoutException)) \
+                        or not is_driver_alive(crawler.driver):
+                    # the reviews scraped so far are dropped and the parent hands the book out again, the next job
+                    # starts a new browser
+                    logger.warning("Worker %s: browser crashed while getting reviews: %s", worker_id, e)
+                    quit_driver(crawler.driver)
+                    crawler = None
+                    results.put(("crashed", worker_id, book_id, metrics.snapshot(reset=True)))
+                    continue
+                logger.warning("Worker %s: something went wrong while getting reviews: %s", worker_id, e)
+            results.put(("done", worker_id, book_id, reviews, metrics.snapshot(reset=True)))
+    finally:
+        if crawler is not None:
+            quit_driver(crawler.driver)
+
+
+class CrawlerPool:
+    '''Hands out per-book review jobs to headless Chrome workers running in their own processes'''
+
+    def __init__(self, num_workers, driver_path=None, extraction="snapshot", max_restarts=3, metrics=None,
+                 log_level=logging.INFO, rate_limits=None, wait_timeout=10, retries=None, rotate_after=3,
+                 block_resources=True):
+        # spawn gives every worker a clean interpreter instead of a copy of the parent's browser session
+        self.context = multiprocessing.get_context("spawn")
+        self.jobs = self.context.Queue()
+        self.results = self.context.Queue()
+        self.driver_path = driver_path
+        self.extraction = extraction
+        # whether the workers' browsers skip images, stylesheets and fonts
+        self.block_resources = block_resources
+        self.metrics = metrics or Metrics()
+        self.log_level = log_level
+        # the RateLimiter settings of the whole pool, split evenly between the workers so they don't go num_workers
+        # times faster together, and the page wait timeout of every worker
+        self.rate_limits = {key: value / num_workers if key in ("rate", "min_rate", "max_rate") and value else value
+                            for key, value in (rate_limits or {}).items()}
+        self.wait_timeout = wait_timeout
+        # books amazon blocked wait here until they can be handed out again, and a worker starts a new browser after
+        # being blocked rotate_after times in a row
+        self.retries = retries if retries is not None else RetryQueue()
+        self.rotate_after = rotate_after
+        # a worker that keeps crashing is given up on after this many restarts, and so is a book whose browser
+        # crashed that many times
+        self.max_restarts = max_restarts
+        self.restarts = {}
+        self.crashes = {}
+
+        # jobs that were submitted but haven't come back yet, the job each worker is busy with and the reviews of
+        # the jobs that came back since they were last collected
+        self.pending = {}
+        self.in_flight = {}
+        self.finished = []
+
+        self.workers = {}
+        self.profile_dirs = {}
+        for worker_id in range(num_workers):
+            self.profile_dirs[worker_id] = tempfile.mkdtemp(prefix=f"crawler-worker-{worker_id}-")
+            self.start_worker(worker_id)
+
+    def start_worker(self, worker_id):
+        '''Starts (or restarts) the process of a worker'''
+        process = self.context.Process(target=review_worker,
+                                       args=(worker_id, self.jobs, self.results, self.driver_path,
+                                             self.profile_dirs[worker_id], self.extraction, self.log_level,
+                                             self.rate_limits, self.wait_timeout, self.rotate_after,
+                                             self.block_resources),
+                                       daemon=True)
+        process.start()
+        self.workers[worker_id] = process
+
+    def submit(self, book_id, reviews_url, max_num_reviews, last_review_page_url=None, known=None):
+        '''Queues the reviews of a book to be scraped by the next free worker. known holds the fingerprints of the
+        reviews scraped by earlier crawls when the crawl is incremental'''
+        job = (book_id, reviews_url, max_num_reviews, last_review_page_url, known)
+        self.pending[book_id] = job
+        self.jobs.put(job)
+
+    def check_workers(self):
+        '''Restarts workers whose process died and puts the job they were working on back in the queue'''
+        for worker_id, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+
+            book_id = self.in_flight.pop(worker_id, None)
+            self.restarts[worker_id] = self.restarts.get(worker_id, 0) + 1
+            if self.restarts[worker_id] > self.max_restarts:
+                logger.error("Worker %s keeps crashing, giving up on it", worker_id)
+                del self.workers[worker_id]
+                if book_id in self.pending:
+                    # the job may be what crashes the browser so we don't hand it to another worker. it is left
+                    # unfinished for a resumed run to try again
+                    del self.pending[book_id]
+                    self.finished.append((book_id, None))
+                continue
+
+            logger.warning("Worker %s died, restarting it...", worker_id)
+            if book_id in self.pending:
+                self.jobs.put(self.pending[book_id])
+            self.start_worker(worker_id)
+
+        if not self.workers and self.pending:
+            logger.error("Every worker crashed, the remaining books are left unfinished")
+            for book_id in self.pending:
+                self.finished.append((book_id, None))
+            self.pending.clear()
+
+    def drain(self, timeout=None):
+        '''Handles the messages sent by the workers, waiting up to timeout seconds for the first one'''
+        while True:
+            try:
+                message = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            except queue.Empty:
+                return
+            timeout = None
+
+            if message[0] == "started":
+                _, worker_id, book_id = message
+                self.in_flight[worker_id] = book_id
+            elif message[0] == "blocked":
+                _, worker_id, book_id, kind, worker_metrics = message
+                self.metrics.merge(worker_metrics)
+                self.in_flight.pop(worker_id, None)
+                self.retry(book_id)
+            elif message[0] == "crashed":
+                _, worker_id, book_id, worker_metrics = message
+                self.metrics.merge(worker_metrics)
+                self.in_flight.pop(worker_id, None)
+                self.crashed(book_id)
+            else:
+                _, worker_id, book_id, reviews, worker_metrics = message
+                self.metrics.merge(worker_metrics)
+                self.in_flight.pop(worker_id, None)
+                if self.pending.pop(book_id, None) is not None:
+                    self.finished.append((book_id, reviews))
+
+    def retry(self, book_id):
+        '''Schedules a blocked book to be handed out again after its backoff, or gives up on it after too many
+        attempts. A book given up on comes back with None instead of reviews'''
+        job = self.pending.get(book_id)
+        if job is None:
+            return
+        delay = self.retries.push(book_id, job)
+        if delay is None:
+            logger.error("Amazon keeps blocking book %s, giving up on it for this run", book_id)
+            del self.pending[book_id]
+            self.finished.append((book_id, None))
+        else:
+            logger.info("Trying book %s again in %.0fs", book_id, delay)
+
+    def crashed(self, book_id):
+        '''Hands a book whose browser crashed to the next free worker, or gives up on it once it crashed more than
+        max_restarts times. A book given up on comes back with None instead of reviews'''
+        job = self.pending.get(book_id)
+        if job is None:
+            return
+        self.crashes[book_id] = self.crashes.get(book_id, 0) + 1
+        if self.crashes[book_id] > self.max_restarts:
+            # the book may be what crashes the browser so it is left unfinished for a resumed run to try again
+            logger.error("The browser keeps crashing on book %s, giving up on it for this run", book_id)
+            del self.pending[book_id]
+            self.finished.append((book_id, None))
+        else:
+            logger.warning("The browser crashed on book %s, trying it again...", book_id)
+            self.jobs.put(job)
+
+    def resubmit_retries(self):
+        '''Hands the blocked books whose backoff is over back to the workers'''
+        for job in self.retries.pop_ready():
+            self.jobs.put(job)
+
+    def collect(self):
+        '''Returns the book IDs and reviews of the jobs that finished since the last call, without waiting. A book
+        that couldn't be scraped comes back with None instead of reviews'''
+        self.drain()
+        # a worker that died is noticed as the crawl goes, not only once it waits for the pool
+        self.check_workers()
+        self.resubmit_retries()
+        finished, self.finished = self.finished, []
+        return finished
+
+    def join(self):
+        '''Waits for every submitted job and returns the book IDs and reviews of the jobs not collected yet'''
+        while self.pending:
+            self.drain(timeout=1)
+            self.check_workers()
+            # blocked books are still pending while they wait out their backoff
+            self.resubmit_retries()
+        return self.collect()
+
+    def close(self, timeout=30):
+        '''Lets every worker finish its current job and quit its browser before stopping the pool'''
+        for _ in self.workers:
+            self.jobs.put(None)
+        for process in self.workers.values():
+            process.join(timeout)
+            if process.is_alive():
+                # the worker didn't stop in time so we have to kill it
+                process.terminate()
+        for profile_dir in self.profile_dirs.values():
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
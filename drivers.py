@@ -0,0 +1,107 @@
+'''Starts the Chrome web drivers used by the crawlers'''
+import json
+import logging
+import os
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service as ChromeService
+
+from webdriver_manager.chrome import ChromeDriverManager
+from webdriver_manager.core.os_manager import ChromeType, OperationSystemManager
+
+logger = logging.getLogger(__name__)
+
+# where the path of the last chromedriver webdriver_manager resolved is kept, with the Chrome version it matches
+DRIVER_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "amazon-book-review-scraper", "chromedriver.json")
+
+# the scraped pages are read from their html, so the browser doesn't need to download what only draws them. the
+# patterns end with a wildcard so urls with a query string, as amazon's stylesheets have, are blocked too
+BLOCKED_RESOURCES = ["*.css*", "*.woff*", "*.ttf*", "*.otf*", "*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*",
+                     "*.svg*", "*.ico*"]
+
+
+def installed_chrome_version():
+    '''Returns the major version of the installed Chrome, found without going online, or None if it can't be told'''
+    try:
+        version = OperationSystemManager().get_browser_version_from_os(ChromeType.GOOGLE)
+    except Exception:
+        return None
+    return version.split(".")[0] if version else None
+
+
+def resolve_driver_path(cache_file=DRIVER_CACHE):
+    '''Returns the path of the chromedriver matching the installed Chrome. The driver webdriver_manager resolved last
+    time is used as long as it is still there and Chrome hasn't changed major version, otherwise webdriver_manager
+    looks up the matching version online and downloads it if needed'''
+    chrome_version = installed_chrome_version()
+    try:
+        with open(cache_file, encoding="utf-8") as cached_file:
+            cached = json.load(cached_file)
+    except (OSError, ValueError):
+        cached = {}
+    driver_path = cached.get("driver_path")
+    if driver_path and os.path.exists(driver_path) and chrome_version in (None, cached.get("chrome_version")):
+        # we skip webdriver_manager's version lookup, which goes online every time
+        return driver_path
+
+    # taken from selenium documentation. Basically sets up the browser engine automatically for you
+    driver_path = ChromeDriverManager().install()
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w", encoding="utf-8") as cached_file:
+            json.dump({"driver_path": driver_path, "chrome_version": chrome_version}, cached_file)
+    except OSError as e:
+        logger.warning("Couldn't remember the chromedriver in %s: %s", cache_file, e)
+    return driver_path
+
+
+def create_chrome_driver(driver_path=None, headless=True, profile_dir=None, user_agent=None, block_resources=True,
+                         debugger_address=None):
+    '''Starts a new Chrome session, by default without a window and without loading images, stylesheets and fonts.
+    It can have its own profile directory, kept from one run to the next so the browser starts with a warm cache and
+    its cookies, and another user agent than Chrome's own. With debugger_address it attaches to a Chrome that is
+    already running with --remote-debugging-port instead of starting one, and loads everything'''
+    service = ChromeService(executable_path=driver_path or resolve_driver_path())
+
+    options = Options()
+    if debugger_address:
+        # the running browser keeps the options it was started with
+        options.debugger_address = debugger_address
+    else:
+        if headless:
+            # runs the crawler without opening a browser application on your computer
+            options.add_argument("--headless=new")
+        if profile_dir:
+            # every browser running at the same time needs a profile directory of its own
+            options.add_argument(f"--user-data-dir={profile_dir}")
+        if user_agent:
+            options.add_argument(f"--user-agent={user_agent}")
+        if block_resources:
+            options.add_argument("--blink-settings=imagesEnabled=false")
+            options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    driver = webdriver.Chrome(service=service, options=options)
+    if block_resources and not debugger_address:
+        # chrome has no setting for stylesheets and fonts so their requests are dropped by the devtools protocol.
+        # a browser we attached to is the user's own so its pages are left as they are
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_RESOURCES})
+    return driver
+
+
+def is_driver_alive(driver):
+    '''Checks that the browser behind a driver still responds'''
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+def quit_driver(driver):
+    '''Ends a browser session, ignoring errors from browsers that already crashed'''
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
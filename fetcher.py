@@ -0,0 +1,84 @@
+'''Fetches pages over plain HTTP without a browser'''
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from blocking import OK, PageBlocked, classify_page, next_user_agent
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/126.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+
+class HttpFetcher:
+    '''Fetches pages through a pooled keep-alive session that keeps cookies between requests'''
+
+    def __init__(self, headers=None, pool_size=10, timeout=30, max_retries=3, cache=None):
+        self.timeout = timeout
+        self.headers = headers or DEFAULT_HEADERS
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        # optional PageCache checked before going to the network
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.session = self.new_session(self.headers)
+
+    def new_session(self, headers):
+        '''Creates a session with no cookies and its own pool of connections'''
+        session = requests.Session()
+        session.headers.update(headers)
+
+        # retry transient failures with a backoff instead of failing the whole book. 429 and 503 are how amazon
+        # throttles us, those are left to the crawler which backs off for much longer
+        retry = Retry(total=self.max_retries,
+                      backoff_factor=1,
+                      status_forcelist=[500, 502, 504],
+                      allowed_methods=["GET"])
+
+        # keep a pool of open connections per host so every page reuses an existing connection
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def rotate_session(self):
+        '''Starts over with a new session, dropping the cookies amazon tied to the old one, under the next user
+        agent. Requests already made with the old session are left to finish'''
+        with self.lock:
+            self.session = self.new_session({**self.headers, "User-Agent": next_user_agent()})
+
+    def get(self, url, before_request=None):
+        '''Fetches a page and returns its final url (after redirects) and its html. A stale cached copy is
+        revalidated with a conditional request and reused if the server says it didn't change.
+        before_request is called right before going to the network, but not when the page comes from the cache.
+        Raises PageBlocked when amazon serves a captcha, a robot check or a throttling page instead'''
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None and cached.fresh:
+            return cached.final_url, cached.text
+
+        headers = cached.revalidation_headers() if cached is not None else {}
+        if before_request is not None:
+            before_request()
+        response = self.session.get(url, timeout=self.timeout, headers=headers)
+        if cached is not None and response.status_code == 304:
+            self.cache.refresh(url)
+            return cached.final_url, cached.text
+
+        kind = classify_page(response.text, response.status_code)
+        if kind != OK:
+            # blocked pages are never cached
+            raise PageBlocked(url, kind)
+        response.raise_for_status()
+        if self.cache is not None:
+            self.cache.put(url, response.url, response.text,
+                           response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return response.url, response.text
+
+    def close(self):
+        '''Closes every pooled connection'''
+        self.session.close()
@@ -0,0 +1,151 @@
+'''The searches a crawl goes through: search queries and categories of amazon's books, each with its own range of
+result pages and its own limits. They are read from a job file or given on the command line'''
+import functools
+import json
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from checkpoint import book_key, start_or_resume_book
+from records import BookQuery
+
+AMAZON_SEARCH_URL = "https://www.amazon.com/s"
+
+# the keys a search can have in a job file
+SEARCH_KEYS = {"query", "category", "url", "department", "pages", "max_books", "max_reviews", "name"}
+
+
+def page_number(url):
+    '''Returns the number of the page of search results a url points at'''
+    return int(dict(parse_qsl(urlsplit(url).query)).get("page", 1))
+
+
+class SearchJob:
+    '''One search of amazon's books: a query, a category (the ID of a browse node, like 25 for science fiction
+    and fantasy), both, or the url of a page of search results. Its results are read from first_page to last_page,
+    and max_books and max_reviews cap the books found by this search and the reviews of each of them, on top of the
+    limits of the whole crawl'''
+
+    def __init__(self, query=None, category=None, url=None, department="stripbooks", first_page=1, last_page=None,
+                 max_books=None, max_reviews=None, name=None):
+        if query is None and category is None and url is None:
+            raise ValueError("A search needs a query, a category or a url")
+        if first_page < 1 or (last_page is not None and last_page < first_page):
+            raise ValueError(f"Invalid range of pages: {first_page} to {last_page}")
+        self.query = query
+        self.category = category
+        self.url = url
+        self.department = department
+        self.first_page = first_page
+        self.last_page = last_page
+        self.max_books = max_books
+        self.max_reviews = max_reviews
+        # the books found by this search are mapped to its name in the output
+        self.name = name or query or (f"category {category}" if category is not None else url)
+        # where a resumed crawl finds the page of results it got to, and whether it got through all of them
+        self.frontier_key = f"frontier_url:{self.name}"
+        self.done_key = f"search_done:{self.name}"
+        self.frontier_url = None
+
+    @classmethod
+    def from_dict(cls, spec):
+        '''Reads a search from a job file, where the range of pages is given as "pages": [first, last]'''
+        unknown = set(spec) - SEARCH_KEYS
+        if unknown:
+            raise ValueError(f"Unknown keys in search {spec}: {', '.join(sorted(unknown))}")
+        spec = dict(spec)
+        first_page, last_page = spec.pop("pages", [1, None])
+        return cls(first_page=first_page, last_page=last_page, **spec)
+
+    def start_url(self):
+        '''Returns the page of results the search starts from, or carries on from when the crawl is resumed'''
+        if self.frontier_url is not None:
+            return self.frontier_url
+        if self.url is not None:
+            scheme, netloc, path, query, _ = urlsplit(self.url)
+            params = dict(parse_qsl(query))
+        else:
+            scheme, netloc, path = urlsplit(AMAZON_SEARCH_URL)[:3]
+            params = {"i": self.department}
+            if self.query is not None:
+                params["k"] = self.query
+            if self.category is not None:
+                params["rh"] = f"n:{self.category}"
+        if self.first_page > 1:
+            params["page"] = self.first_page
+        return urlunsplit((scheme, netloc, path, urlencode(params), ""))
+
+    def has_next_page(self, url):
+        '''Checks whether the page of results after the one at url is still in the range of the search'''
+        return self.last_page is None or page_number(url) < self.last_page
+
+
+def load_jobs(path):
+    '''Reads the searches of a job file. It is a JSON list of searches, or an object with the list under
+    "searches" and the keys every search has unless it sets them itself under "defaults"'''
+    with open(path, encoding="utf-8") as jobs_file:
+        spec = json.load(jobs_file)
+    if isinstance(spec, list):
+        spec = {"searches": spec}
+    defaults = spec.get("defaults", {})
+    return [SearchJob.from_dict({**defaults, **search}) for search in spec["searches"]]
+
+
+class BookListings:
+    '''Remembers every book the searches listed, by its ASIN, so a book listed by several searches is only scraped
+    once, and which searches listed it'''
+
+    def __init__(self, state=None):
+        self.book_ids = {}
+        # when a CrawlState is given the listings are checkpointed once they are written, so a resumed crawl doesn't
+        # write them again
+        self.state = state
+        self.listed = set()
+        self.pending = []
+
+    def found(self, book_id, query):
+        '''Records that a search listed a book'''
+        if query is None or (book_id, query) in self.listed:
+            return
+        self.listed.add((book_id, query))
+        if self.state is None or not self.state.has_book_query(book_id, query):
+            self.pending.append(BookQuery(book_id, query))
+
+    def records(self):
+        '''Yields ("book_query", book_query) records for the listings found since it was last called, each followed
+        by the checkpoint that saves it'''
+        pending, self.pending = self.pending, []
+        for book_query in pending:
+            yield "book_query", book_query
+            # sinks only write a listing once its checkpoint comes, even when there is no CrawlState to save it in
+            yield "checkpoint", functools.partial(self.save, book_query)
+
+    def save(self, book_query):
+        '''Checkpoints a listing that was written out'''
+        if self.state is not None:
+            self.state.add_book_query(book_query.book_id, book_query.query)
+
+
+def start_listed_book(state, listings, book_card, new_book, query=None, book_index=None):
+    '''Starts or resumes the book of a card like start_or_resume_book, recording the search that listed it. A book
+    that was already listed by another search, or that the BookIndex says an earlier crawl scraped recently, is only
+    mapped to this search, and None is returned so it isn't scraped again'''
+    key = book_key(book_card)
+    book_id = listings.book_ids.get(key)
+    if book_id is None and book_index is not None:
+        book_id = book_index.recently_scraped(key)
+        if book_id is not None:
+            listings.book_ids[key] = book_id
+    if book_id is None:
+        started = start_or_resume_book(state, book_card, new_book)
+        if started is not None:
+            book_id = started[0].id
+            listings.book_ids[key] = book_id
+            listings.found(book_id, query)
+            return started
+        # finished by a previous run
+        saved = state.get_book(key) if state is not None else None
+        if saved is None:
+            return None
+        book_id = saved[0].id
+        listings.book_ids[key] = book_id
+    listings.found(book_id, query)
+    return None
@@ -0,0 +1,218 @@
+'''Counts what the crawler does and times every stage of it, so we can tell where a run spends its time'''
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# upper bounds in seconds of the histogram buckets, from a fast parse to a slow page load
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class Histogram:
+    '''Latency histogram of one stage with the same fixed buckets for every stage so they can be merged'''
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        '''Records how long one call took'''
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        '''Estimates a quantile as the upper bound of the bucket it falls in'''
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"counts": list(self.counts), "count": self.count, "sum": self.sum, "max": self.max}
+
+    def merge(self, data):
+        '''Adds the observations of a histogram exported with to_dict'''
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, data["counts"])]
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+
+
+class Metrics:
+    '''Counters and per-stage latency histograms shared by every part of a crawl. Safe to use from several threads'''
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        '''Adds to a counter'''
+        with self.lock:
+            self.counters[name] += amount
+
+    def count(self, name):
+        '''Returns the value of a counter'''
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def observe(self, stage, seconds):
+        '''Records how long one call of a stage took'''
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        '''Times the body of a with statement as one call of a stage'''
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started_at)
+
+    def wrap(self, owner, name, stage):
+        '''Replaces a function of a module, class or object with one that times every call as a stage'''
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            with self.timer(stage):
+                return original(*args, **kwargs)
+
+        setattr(owner, name, timed)
+
+    def snapshot(self, reset=False):
+        '''Returns every counter and histogram as plain data, optionally starting them over'''
+        with self.lock:
+            data = {
+                "elapsed_s": time.monotonic() - self.started_at,
+                "counters": dict(self.counters),
+                "stages": {stage: histogram.to_dict() for stage, histogram in self.histograms.items()},
+            }
+            if reset:
+                self.counters.clear()
+                self.histograms.clear()
+        return data
+
+    def merge(self, data):
+        '''Adds the counters and histograms of a snapshot, such as the ones sent back by pool workers'''
+        with self.lock:
+            for name, value in data["counters"].items():
+                self.counters[name] += value
+            for stage, histogram in data["stages"].items():
+                self.histograms[stage].merge(histogram)
+
+    def report(self):
+        '''Returns the end of run report: every counter, then the calls and latency of every stage'''
+        data = self.snapshot()
+        lines = [f"Run took {data['elapsed_s']:.1f}s"]
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"  {name}: {value}")
+        lines.append(f"  {'stage':<24}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        with self.lock:
+            # the stages the run spent the most time in come first
+            stages = sorted(self.histograms.items(), key=lambda item: item[1].sum, reverse=True)
+            for stage, histogram in stages:
+                lines.append(f"  {stage:<24}{histogram.count:>8}{histogram.sum:>10.2f}"
+                             f"{histogram.sum / histogram.count * 1000:>10.1f}"
+                             f"{histogram.quantile(0.5) * 1000:>10.1f}{histogram.quantile(0.95) * 1000:>10.1f}"
+                             f"{histogram.max * 1000:>10.1f}")
+        return "\n".join(lines)
+
+    def to_json(self):
+        '''Returns a snapshot of the metrics as JSON'''
+        data = self.snapshot()
+        data["buckets"] = [str(bound) for bound in BUCKETS]
+        return json.dumps(data, indent=2)
+
+    def to_prometheus(self):
+        '''Returns the metrics in the Prometheus text exposition format'''
+        data = self.snapshot()
+        lines = []
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"# TYPE scraper_{name}_total counter")
+            lines.append(f"scraper_{name}_total {value}")
+        lines.append("# TYPE scraper_stage_seconds histogram")
+        for stage, histogram in sorted(data["stages"].items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'scraper_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'scraper_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'scraper_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, format="json"):
+        '''Writes the metrics to a file as JSON or Prometheus text'''
+        with open(path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self.to_prometheus() if format == "prometheus" else self.to_json())
+
+
+def instrument_driver(driver, metrics):
+    '''Times every command a web driver sends to its browser. Elements send their commands (find_element, click,
+    reading text...) through the driver too, so every round-trip is counted'''
+    execute = driver.execute
+
+    def timed_execute(driver_command, params=None):
+        metrics.incr(f"webdriver_{driver_command}")
+        with metrics.timer("webdriver"):
+            return execute(driver_command, params)
+
+    driver.execute = timed_execute
+    return driver
+
+
+class ProgressReporter:
+    '''Logs a progress line with the throughput and the time left every few seconds while a crawl runs'''
+
+    def __init__(self, metrics, max_num_books, interval=30):
+        self.metrics = metrics
+        self.max_num_books = max_num_books
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def line(self):
+        '''Returns the progress line for the counters so far'''
+        elapsed = max(time.monotonic() - self.metrics.started_at, 1e-9)
+        books = self.metrics.count("books")
+        reviews = self.metrics.count("reviews")
+        books_per_second = books / elapsed
+        if books_per_second > 0:
+            eta = f"{max(self.max_num_books - books, 0) / books_per_second:.0f}s"
+        else:
+            eta = "unknown"
+        return (f"Progress: {books}/{self.max_num_books} books, {reviews} reviews, {books_per_second:.2f} books/s, "
+                f"{reviews / elapsed:.2f} reviews/s, ETA {eta}")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            logger.info(self.line())
+
+    def start(self):
+        '''Starts logging progress in the background'''
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stops logging progress'''
+        self.stopped.set()
@@ -0,0 +1,202 @@
+'''Keeps fetched pages on disk so a re-crawl doesn't download pages that haven't changed'''
+import hashlib
+import os
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from sqlitestore import open_sqlite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    final_url TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_used_at ON pages (used_at);
+CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest);
+"""
+
+# query parameters amazon adds to links to track where a click came from, they don't change the page
+TRACKING_PARAMS = {"ref", "ref_", "qid", "sr", "crid", "sprefix", "dib", "dib_tag", "content-id", "psc", "th"}
+TRACKING_PREFIXES = ("pd_rd_", "pf_rd_")
+
+
+def normalize_url(url):
+    '''Reduces a url to the parts that decide which page is served, so every link to the same page shares a cache
+    entry: the host is lowercased, tracking parameters and "/ref=..." path segments are dropped and the remaining
+    query parameters (such as pageNumber) are sorted'''
+    scheme, netloc, path, query, _ = urlsplit(url)
+    path = "/".join(segment for segment in path.split("/") if not segment.startswith("ref="))
+    params = sorted((name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+                    if name not in TRACKING_PARAMS and not name.startswith(TRACKING_PREFIXES))
+    return urlunsplit((scheme.lower(), netloc.lower(), path or "/", urlencode(params), ""))
+
+
+class CachedPage:
+    '''A page read from the cache, along with what is needed to ask the server whether it changed'''
+
+    def __init__(self, final_url, text, etag, last_modified, fresh):
+        self.final_url = final_url
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def revalidation_headers(self):
+        '''Returns the headers of a conditional request that only downloads the page again if it changed'''
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageCache:
+    '''On-disk page cache with a time to live and a size limit.
+
+    Pages are looked up by their normalized url in a small SQLite index and their (compressed) html is stored in a
+    file named after the hash of its content, so identical pages reached through different urls are only stored
+    once. When the cache grows past max_bytes the least recently used pages are evicted.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024, ttl=24 * 60 * 60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # pages older than this are revalidated with the server before they are used again
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.join(cache_dir, "pages"), exist_ok=True)
+        self.connection, self.lock = open_sqlite(os.path.join(cache_dir, "index.db"), SCHEMA)
+        with self.lock:
+            # the size of the stored pages is kept up to date as pages come and go, so storing a page doesn't add up
+            # the whole cache. pages sharing their content are counted once, like they are stored
+            self.total_bytes = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM pages)").fetchone()[0]
+
+    def body_path(self, digest):
+        '''Returns the file holding the html with the given content hash'''
+        return os.path.join(self.cache_dir, "pages", digest[:2], digest)
+
+    def get(self, url):
+        '''Returns the cached page for a url, or None if it isn't cached. Stale pages are returned too so they can
+        be revalidated, but only fresh ones count as hits'''
+        key = normalize_url(url)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT final_url, digest, size, etag, last_modified, fetched_at FROM pages WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            final_url, digest, size, etag, last_modified, fetched_at = row
+            try:
+                with open(self.body_path(digest), "rb") as body_file:
+                    text = zlib.decompress(body_file.read()).decode("utf-8")
+            except (OSError, zlib.error):
+                # the file was removed or damaged behind our back so we forget the entry
+                with self.connection:
+                    self.connection.execute("DELETE FROM pages WHERE key = ?", (key,))
+                self.remove_body(digest, size)
+                self.misses += 1
+                return None
+
+            fresh = time.time() - fetched_at < self.ttl
+            if fresh:
+                self.hits += 1
+                with self.connection:
+                    self.connection.execute("UPDATE pages SET used_at = ? WHERE key = ?", (time.time(), key))
+            else:
+                self.stale += 1
+        return CachedPage(final_url, text, etag, last_modified, fresh)
+
+    def put(self, url, final_url, text, etag=None, last_modified=None):
+        '''Stores a freshly downloaded page and evicts the least recently used pages if the cache got too big'''
+        key = normalize_url(url)
+        body = zlib.compress(text.encode("utf-8"))
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.body_path(digest)
+        now = time.time()
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # written under a temporary name first so a crash never leaves half a page behind
+                with open(path + ".tmp", "wb") as body_file:
+                    body_file.write(body)
+                os.replace(path + ".tmp", path)
+
+            with self.connection:
+                old = self.connection.execute("SELECT digest, size FROM pages WHERE key = ?", (key,)).fetchone()
+                if not self.in_use(digest):
+                    self.total_bytes += len(body)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO pages (key, final_url, digest, size, etag, last_modified, fetched_at, "
+                    "used_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, final_url, digest, len(body), etag, last_modified, now, now))
+            if old is not None and old[0] != digest:
+                self.remove_body(*old)
+            self.evict()
+
+    def refresh(self, url):
+        '''Marks a cached page as fresh again after the server said it didn't change'''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE pages SET fetched_at = ?, used_at = ? WHERE key = ?",
+                                    (now, now, normalize_url(url)))
+            self.revalidated += 1
+
+    def in_use(self, digest):
+        '''Checks whether a url still points at the html with the given content hash. Called with the lock held'''
+        return self.connection.execute("SELECT 1 FROM pages WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+    def remove_body(self, digest, size):
+        '''Deletes the html of a page unless another url still points at the same content. Called with the lock
+        held'''
+        if self.in_use(digest):
+            return
+        try:
+            os.remove(self.body_path(digest))
+        except OSError:
+            pass
+        self.total_bytes -= size
+
+    def evict(self):
+        '''Drops the least recently used pages until the cache fits in max_bytes. Called with the lock held'''
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        # the least recently used pages are read a few at a time, an eviction usually only drops a handful
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute("SELECT key, digest, size FROM pages ORDER BY used_at LIMIT 16").fetchall()
+            if not rows:
+                break
+            for key, digest, size in rows:
+                with self.connection:
+                    self.connection.execute("DELETE FROM pages WHERE key = ?", (key,))
+                self.evictions += 1
+                self.remove_body(digest, size)
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def report(self):
+        '''Returns a one line summary of how useful the cache was'''
+        lookups = self.hits + self.stale + self.misses
+        hit_rate = (self.hits + self.revalidated) / lookups if lookups else 0
+        return (f"Cache: {self.hits} hits, {self.revalidated} of {self.stale} stale pages revalidated, "
+                f"{self.misses} misses "
+                f"({hit_rate:.0%} served from cache), {self.evictions} evicted")
+
+    def close(self):
+        '''Closes the index of the cache'''
+        self.connection.close()
@@ -0,0 +1,196 @@
+'''Parses books and reviews out of a single HTML snapshot of a page.
+
+Asking the web driver for every field of every book or review costs one round-trip per call, so instead we
+grab the page source once and extract everything locally with precompiled XPath selectors.
+'''
+import re
+from urllib.parse import urljoin
+
+from lxml import etree, html
+
+from records import Review
+
+
+def _has_class(name):
+    '''Builds an XPath predicate that matches elements having the given class'''
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# the selectors below mirror the CSS selectors used by the selenium crawler
+BOOK_CARDS = etree.XPath(f"//*[{_has_class('sg-col-inner')}]/*[{_has_class('s-widget-container')}]")
+BOOK_TITLE_AUTHORS = etree.XPath(f".//*[{_has_class('s-title-instructions-style')}]")
+BOOK_PRICE = etree.XPath(f".//span[{_has_class('a-price')}]/span[{_has_class('a-offscreen')}]")
+BOOK_RATINGS = etree.XPath(f".//span[{_has_class('a-icon-alt')}]")
+BOOK_NUM_REVIEWS = etree.XPath(
+    f".//div[{_has_class('s-title-instructions-style')}]"
+    f"/following-sibling::div[1][{_has_class('a-section')}]"
+    f"/div[{_has_class('a-row')}]/*[2][self::span]"
+)
+NEXT_BOOK_PAGE = etree.XPath(f"//a[{_has_class('s-pagination-next')}]")
+
+ALL_REVIEWS_LINK = etree.XPath(
+    f"//div[@id='cr-pagination-footer-0']/a | //div[@id='reviews-medley-footer']/div[{_has_class('a-row')}]/a"
+)
+REVIEWS = etree.XPath(f"//div[{_has_class('a-section')} and {_has_class('review')}]")
+REVIEW_TITLE = etree.XPath(f".//a[{_has_class('review-title')}]")
+REVIEW_DATE = etree.XPath(f".//span[{_has_class('review-date')}]")
+REVIEW_RATING = etree.XPath(f".//span[{_has_class('a-icon-alt')}]")
+REVIEW_BODY = etree.XPath(f".//span[{_has_class('review-text-content')}]/span")
+REVIEW_HELPFUL_VOTES = etree.XPath(f".//span[{_has_class('cr-vote-text')}]")
+NEXT_REVIEW_PAGE = etree.XPath(f"//ul[{_has_class('a-pagination')}]/li[{_has_class('a-last')}]/a")
+
+WHITESPACE = re.compile(r"\s+")
+ASIN = re.compile(r"/(?:dp|product-reviews|gp/product)/([A-Z0-9]{10})(?:[/?#]|$)")
+AUTHOR_SEPARATOR = re.compile(r"by|Book \d+ of \d+:")
+
+
+def parse_asin(url):
+    '''Returns the ASIN (amazon's product ID) found in a product or reviews url, or None'''
+    match = ASIN.search(url)
+    return match.group(1) if match else None
+
+
+def parse_document(page_source):
+    '''Parses the raw page source into an element tree'''
+    return html.document_fromstring(page_source)
+
+
+def text(el):
+    '''Returns the text of an element with the whitespace collapsed, like the driver's rendered text'''
+    return WHITESPACE.sub(" ", el.text_content()).strip()
+
+
+def inner_html(el):
+    '''Returns the inner HTML of an element, equivalent to reading its innerHTML attribute'''
+    return (el.text or "") + "".join(etree.tostring(child, encoding="unicode", with_tail=True) for child in el)
+
+
+def plain_text(el):
+    '''Returns the text of an element with its tags stripped, keeping its line breaks as new lines'''
+    for br in el.iter("br"):
+        br.tail = "\n" + (br.tail or "")
+    return "\n".join(line.strip() for line in el.text_content().split("\n")).strip()
+
+
+def lines(el):
+    '''Splits an element into the lines the browser would render, one per child element'''
+    child_lines = [text(child) for child in el if isinstance(child.tag, str)]
+    return [line for line in child_lines if line] or [text(el)]
+
+
+def first(selector, el):
+    '''Returns the first element matched by a selector or None if there are no matches'''
+    matches = selector(el)
+    return matches[0] if matches else None
+
+
+def parse_book_card(el, base_url=None):
+    '''Extracts the fields of a single book card. Missing fields default the same way as the selenium crawler'''
+    title_authors_el = first(BOOK_TITLE_AUTHORS, el)
+    try:
+        # the title and author are always the last two lines of the title section
+        title_authors = lines(title_authors_el)
+        title = title_authors[-2].strip()
+        authors = AUTHOR_SEPARATOR.split(title_authors[-1])[1].strip()
+    except (TypeError, IndexError):
+        title = ""
+        authors = ""
+
+    price_el = first(BOOK_PRICE, el)
+    price = float(inner_html(price_el).replace("$", "").replace(",", "")) if price_el is not None else None
+
+    ratings_el = first(BOOK_RATINGS, el)
+    ratings = float(inner_html(ratings_el).split(" ")[0]) if ratings_el is not None else None
+
+    num_reviews = None
+    reviews_url = None
+    num_reviews_el = first(BOOK_NUM_REVIEWS, el)
+    if num_reviews_el is not None:
+        num_reviews = int(text(num_reviews_el).replace(",", ""))
+        reviews_url_el = num_reviews_el.find(".//a")
+        if reviews_url_el is not None and reviews_url_el.get("href"):
+            reviews_url = urljoin(base_url or "", reviews_url_el.get("href"))
+
+    return {
+        "title": title,
+        "authors": authors,
+        "price": price,
+        "ratings": ratings,
+        "num_reviews": num_reviews,
+        "reviews_url": reviews_url,
+    }
+
+
+def parse_books(page_source, base_url=None):
+    '''Parses every book card on a search results page'''
+    doc = parse_document(page_source)
+    return [parse_book_card(el, base_url) for el in BOOK_CARDS(doc)]
+
+
+def parse_review(el):
+    '''Extracts the fields of a single review. Missing fields default the same way as the selenium crawler'''
+    title_el = first(REVIEW_TITLE, el)
+    if title_el is not None:
+        # the title link also holds the star rating in a hidden span so we only take the last line
+        title = lines(title_el)[-1]
+    else:
+        title = ""
+
+    date_and_location_el = first(REVIEW_DATE, el)
+    if date_and_location_el is not None:
+        # date and location is usually separated by the word "on" so we split on that, the first 15 characters
+        # of the location are irrelevant
+        location, date = inner_html(date_and_location_el).split("on")
+        date = date.strip()
+        location = location[16:].strip()
+    else:
+        date = ""
+        location = ""
+
+    rating_el = first(REVIEW_RATING, el)
+    rating = float(inner_html(rating_el).split(" ")[0]) if rating_el is not None else None
+
+    body_el = first(REVIEW_BODY, el)
+    body = plain_text(body_el) if body_el is not None else ""
+
+    num_helpful_votes_el = first(REVIEW_HELPFUL_VOTES, el)
+    if num_helpful_votes_el is not None:
+        # amazon uses the word "One" for a single vote and digits for anything more
+        num_helpful_votes = text(num_helpful_votes_el).split(" ")[0]
+        num_helpful_votes = 1 if num_helpful_votes == "One" else int(num_helpful_votes.replace(",", ""))
+    else:
+        num_helpful_votes = None
+
+    return Review(title, location, date, rating, body, num_helpful_votes)
+
+
+def parse_reviews(page_source):
+    '''Parses every review on a page of reviews'''
+    doc = parse_document(page_source)
+    return [parse_review(el) for el in REVIEWS(doc)]
+
+
+def parse_next_page_url(page_source, selector, disabled_class, base_url=None):
+    '''Returns the url behind a pagination "next" link or None if there is no next page'''
+    next_el = first(selector, parse_document(page_source))
+    if next_el is None or disabled_class in (next_el.get("class") or "").split() or not next_el.get("href"):
+        return None
+    return urljoin(base_url or "", next_el.get("href"))
+
+
+def parse_next_book_page_url(page_source, base_url=None):
+    '''Returns the url of the next page of search results or None if this is the last page'''
+    return parse_next_page_url(page_source, NEXT_BOOK_PAGE, "s-pagination-disabled", base_url)
+
+
+def parse_next_review_page_url(page_source, base_url=None):
+    '''Returns the url of the next page of reviews or None if this is the last page'''
+    return parse_next_page_url(page_source, NEXT_REVIEW_PAGE, "a-disabled", base_url)
+
+
+def parse_all_reviews_url(page_source, base_url=None):
+    '''Returns the url behind the "see all reviews" link on a product page'''
+    link_el = first(ALL_REVIEWS_LINK, parse_document(page_source))
+    if link_el is None or not link_el.get("href"):
+        return None
+    return urljoin(base_url or "", link_el.get("href"))
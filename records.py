@@ -0,0 +1,114 @@
+'''The books and reviews passed from the crawlers to the sinks.
+
+A big crawl passes hundreds of thousands of reviews around, so instead of a dict per row, each with its own table of
+keys, they are objects with a fixed set of slots. Their fields are checked when they are created so a page that
+didn't parse the way it should fails there rather than in the middle of writing the outputs.
+'''
+import sys
+
+BOOK_FIELDS = ("id", "title", "authors", "price", "ratings", "num_reviews")
+REVIEW_FIELDS = ("id", "book_id", "title", "location", "reviewed_on", "rating", "body", "num_helpful_votes")
+BOOK_QUERY_FIELDS = ("book_id", "query")
+
+
+class InvalidRecord(ValueError):
+    '''Raised when a scraped field doesn't have the type or the range it should'''
+
+
+def check_text(name, value):
+    '''Checks a text field'''
+    if not isinstance(value, str):
+        raise InvalidRecord(f"{name} should be text, got {value!r}")
+    return value
+
+
+def check_number(name, value, high=None):
+    '''Checks an optional number that can't be negative (a price or a number of stars), as a float'''
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise InvalidRecord(f"{name} should be a number, got {value!r}")
+    if value < 0 or (high is not None and value > high):
+        raise InvalidRecord(f"{name} is out of range: {value!r}")
+    return float(value)
+
+
+def check_count(name, value):
+    '''Checks an optional count or ID'''
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise InvalidRecord(f"{name} should be a whole number that isn't negative, got {value!r}")
+    return value
+
+
+class Record:
+    '''Base class of the books and reviews: a fixed set of fields stored in slots'''
+    __slots__ = ()
+    fields = ()
+
+    def to_row(self):
+        '''Returns the values of the fields in order, as a csv row'''
+        return tuple(getattr(self, name) for name in self.fields)
+
+    def to_dict(self):
+        '''Returns the fields as a dict, as a JSON object'''
+        return {name: getattr(self, name) for name in self.fields}
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Builds a record from a dict returned by to_dict, such as a checkpointed one'''
+        return cls(**{name: data.get(name) for name in cls.fields})
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_row() == other.to_row()
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.fields)
+        return f"{type(self).__name__}({fields})"
+
+
+class Book(Record):
+    '''A book from the search results'''
+    # the crawlers forget what they kept about a book once the consumer of iter_books lets go of it
+    __slots__ = BOOK_FIELDS + ("__weakref__",)
+    fields = BOOK_FIELDS
+
+    def __init__(self, id, title, authors, price=None, ratings=None, num_reviews=None):
+        self.id = check_count("id", id)
+        self.title = check_text("title", title)
+        self.authors = check_text("authors", authors)
+        self.price = check_number("price", price)
+        self.ratings = check_number("ratings", ratings, high=5)
+        self.num_reviews = check_count("num_reviews", num_reviews)
+
+
+class Review(Record):
+    '''A review of a book. Reviews are parsed before they are numbered, so id and book_id are set by the crawler
+    that saves them'''
+    __slots__ = REVIEW_FIELDS
+    fields = REVIEW_FIELDS
+
+    def __init__(self, title, location, reviewed_on, rating=None, body="", num_helpful_votes=None, id=None,
+                 book_id=None):
+        self.id = check_count("id", id)
+        self.book_id = check_count("book_id", book_id)
+        self.title = check_text("title", title)
+        # a handful of locations and dates are repeated across every review so they share a single string each
+        self.location = sys.intern(check_text("location", location))
+        self.reviewed_on = sys.intern(check_text("reviewed_on", reviewed_on))
+        self.rating = check_number("rating", rating, high=5)
+        # plain text, the tags of the review's html are stripped when it is parsed
+        self.body = check_text("body", body)
+        self.num_helpful_votes = check_count("num_helpful_votes", num_helpful_votes)
+
+
+class BookQuery(Record):
+    '''One of the searches that listed a book, a book listed by several searches has one for each'''
+    __slots__ = BOOK_QUERY_FIELDS
+    fields = BOOK_QUERY_FIELDS
+
+    def __init__(self, book_id, query):
+        self.book_id = check_count("book_id", book_id)
+        # searches keep their name for every book they list
+        self.query = sys.intern(check_text("query", query))
@@ -0,0 +1,81 @@
+'''Remembers every review scraped by earlier crawls so a re-crawl only picks up the new ones'''
+import hashlib
+
+from sqlitestore import open_sqlite
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reviews (
+    id INTEGER PRIMARY KEY,
+    book_key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    UNIQUE (book_key, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+
+def review_fingerprint(review):
+    '''Identifies a review by a hash of its title, date and body, which don't change when it gets more votes'''
+    content = "\x1f".join([review.title, review.reviewed_on, review.body])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def is_known_page(reviews_fields, known):
+    '''Checks whether every review on a page was already scraped. Reviews are sorted newest first, so there is
+    nothing new on the pages after it either'''
+    return bool(reviews_fields) and all(review_fingerprint(review) in known for review in reviews_fields)
+
+
+class ReviewIndex:
+    '''SQLite index of the reviews of every book, kept across crawls.
+
+    Books are identified by their book_key (their ASIN if they have one) and reviews by their fingerprint. A review
+    gets its ID the first time it is seen and keeps it in every later crawl. It is only added to the index once it
+    was written out, so a review lost by an interrupted run is still new to the next one.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection, self.lock = open_sqlite(path, SCHEMA)
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+            # indexes from before IDs were reserved only have their reviews to go by
+            self.next_id = row[0] if row else self.connection.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM reviews").fetchone()[0]
+
+    def known(self, book_key):
+        '''Returns the fingerprints of every review of a book scraped so far'''
+        with self.lock:
+            rows = self.connection.execute("SELECT fingerprint FROM reviews WHERE book_key = ?", (book_key,))
+            return {fingerprint for fingerprint, in rows}
+
+    def new_reviews(self, book_key, book_id, reviews_fields):
+        '''Numbers the reviews that weren't scraped before with new IDs, leaving out the ones that were. The reviews
+        are only added to the index by add_reviews'''
+        reviews = []
+        with self.lock, self.connection:
+            for review in reviews_fields:
+                if self.connection.execute("SELECT 1 FROM reviews WHERE book_key = ? AND fingerprint = ?",
+                                           (book_key, review_fingerprint(review))).fetchone():
+                    continue
+                review.id = self.next_id
+                review.book_id = book_id
+                self.next_id += 1
+                reviews.append(review)
+            # the IDs are taken even if the reviews don't make it to disk, so they are never handed out twice
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (self.next_id,))
+        return reviews
+
+    def add_reviews(self, book_key, reviews):
+        '''Adds reviews numbered by new_reviews to the index once they were written out'''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO reviews (id, book_key, fingerprint) VALUES (?, ?, ?)",
+                [(review.id, book_key, review_fingerprint(review)) for review in reviews])
+
+    def close(self):
+        '''Closes the index'''
+        self.connection.close()
@@ -0,0 +1,380 @@
+'''Schedules review pages concurrently behind a shared rate limit'''
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import parsers
+from blocking import PageBlocked
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    '''Token bucket that limits how many pages per second are requested across every worker.
+
+    When min_rate and max_rate are given the rate tunes itself: it is halved every time amazon answers with a robot
+    check and creeps back up after every normal page.
+    '''
+
+    def __init__(self, rate=1.0, burst=1, jitter=0.5, min_rate=None, max_rate=None):
+        # tokens added per second, the most tokens that can pile up and the maximum random delay added on top
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.min_rate = rate if min_rate is None else min_rate
+        self.max_rate = rate if max_rate is None else max_rate
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        '''Adds the tokens earned since the last update at the current rate. Called with the lock held'''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def slow_down(self, factor=2.0):
+        '''Divides the rate after amazon pushed back, down to min_rate. Returns the new rate'''
+        with self.lock:
+            # tokens earned at the old rate are kept, from now on they come in at the new one
+            self.refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / factor)
+            # whatever was saved up is dropped so the next request really waits
+            self.tokens = min(self.tokens, 0)
+            return self.rate
+
+    def speed_up(self, factor=1.05):
+        '''Raises the rate a little after a page went through normally, up to max_rate. Returns the new rate'''
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate * factor)
+            return self.rate
+
+    def reserve(self):
+        '''Takes a token and returns how many seconds the caller has to wait before using it'''
+        with self.lock:
+            self.refill(time.monotonic())
+
+            # the bucket can go negative so callers queue up behind each other instead of racing for the next token
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        # a little randomness keeps the requests from looking like they are made by a bot
+        return wait + random.uniform(0, self.jitter)
+
+    def acquire(self):
+        '''Blocks until a request may be made. Safe to call from several threads'''
+        time.sleep(self.reserve())
+
+
+class ThroughputCounter:
+    '''Counts the pages, books and reviews scraped so we can tell how fast a run is going'''
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.pages = 0
+        self.books = 0
+        self.reviews = 0
+        self.lock = threading.Lock()
+
+    def add(self, pages=0, books=0, reviews=0):
+        '''Adds to the counters, safe to call from several threads'''
+        with self.lock:
+            self.pages += pages
+            self.books += books
+            self.reviews += reviews
+
+    def report(self):
+        '''Returns a one line summary of the throughput so far'''
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return (f"{self.pages} pages, {self.books} books, {self.reviews} reviews in {elapsed:.1f}s "
+                f"({self.pages / elapsed:.2f} pages/s, {self.reviews / elapsed:.2f} reviews/s)")
+
+
+class BookOrderBuffer:
+    '''Holds the pages of reviews of books that come in out of order until every book before them is done, so
+    reviews can be numbered and written in book order while only the books in between are kept in memory. The pages
+    of the first unfinished book are passed on as they come'''
+
+    def __init__(self):
+        self.expected = deque()
+        self.pages = {}
+        self.finished = {}
+
+    def __len__(self):
+        '''The number of books whose reviews weren't all passed on yet'''
+        return len(self.expected)
+
+    def expect(self, book_id):
+        '''Registers a book whose reviews are on their way, in the order the books were found'''
+        self.expected.append(book_id)
+
+    def add_page(self, book_id, page_url, reviews):
+        '''Stores a page of a book's reviews'''
+        self.pages.setdefault(book_id, []).append((page_url, reviews))
+
+    def finish(self, book_id, done=True):
+        '''Marks that no more pages are coming for a book. done is False when its reviews couldn't all be scraped'''
+        self.finished[book_id] = done
+
+    def ready(self):
+        '''Yields the book ID, the pages (url and reviews) stored so far and whether the book is done, for the
+        finished books that no unfinished book comes before and then the first unfinished one. Whether it is done
+        is None for the unfinished book'''
+        while self.expected:
+            book_id = self.expected[0]
+            pages = self.pages.pop(book_id, [])
+            done = self.finished.pop(book_id, None)
+            if pages or done is not None:
+                yield book_id, pages, done
+            if done is None:
+                return
+            self.expected.popleft()
+
+
+class AsyncCrawlScheduler:
+    '''Fetches the reviews of many books at once while the search results are still being paged through'''
+
+    def __init__(self, crawler, concurrency=4, max_buffered=100, max_books_ahead=50):
+        self.crawler = crawler
+        self.concurrency = concurrency
+        # how many batches of records may wait for the consumer before the crawl pauses
+        self.max_buffered = max_buffered
+        # how many books may be in progress or waiting for the first unfinished one before no new book is scheduled.
+        # a book waiting out a backoff would otherwise have the pages of every book after it pile up in memory. it
+        # never goes below the concurrency so every review worker has a book
+        self.max_books_ahead = max(max_books_ahead, concurrency)
+        # books whose reviews amazon blocked wait in the crawler's retry queue before they are tried again from the
+        # last page that went through
+        self.retries = crawler.retries
+        self.stopping = threading.Event()
+
+    def run(self, max_num_books=100, max_num_reviews=1000, searches=None):
+        '''Yields ("book", book) and ("review", review) records like AmazonBooksWebCrawler.get_books_and_reviews
+        while the crawl runs in a background event loop. When searches are given, several of them are paged through
+        at once and ("book_query", book_query) records map the books to the searches that listed them. Otherwise the
+        results the crawler is on are paged through. ("checkpoint", checkpoint) records save the progress of the
+        crawl and are to be called once every record before them is written, see sinks.Sink'''
+        records = queue.Queue(maxsize=self.max_buffered)
+        self.stopping.clear()
+        thread = threading.Thread(target=asyncio.run,
+                                  args=(self.crawl(max_num_books, max_num_reviews, records, searches),), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = records.get()
+                if batch is None:
+                    break
+                yield from batch
+        finally:
+            # if the consumer stops early we tell the crawl to wind down and unblock it until it does
+            self.stopping.set()
+            while thread.is_alive():
+                try:
+                    records.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    async def emit(self, records, batch):
+        '''Hands a batch of records to the consumer, waiting if it has fallen behind. Once the consumer stopped the
+        batches are dropped, along with their checkpoints'''
+        if batch and not self.stopping.is_set():
+            await asyncio.to_thread(records.put, batch)
+
+    async def emit_ready(self, order, emitting, records):
+        '''Hands the consumer the pages of reviews that no unfinished book comes before. Reviews come in any order so
+        they are numbered and written in book order to keep their IDs deterministic'''
+        async with emitting:
+            for book_id, pages, done in order.ready():
+                batch = []
+                for page_url, reviews_fields in pages:
+                    batch += self.crawler.review_records(book_id, reviews_fields, page_url)
+                if done:
+                    batch.append(self.crawler.checkpoint(self.crawler.finish_book, book_id))
+                # a book that isn't done is left unfinished so a resumed run tries it again
+                await self.emit(records, batch)
+
+    async def until_stopped(self, awaitable, poll_interval=0.1):
+        '''Waits for awaitable unless the consumer stops first, in which case it is cancelled. Returns whether it
+        completed'''
+        task = asyncio.ensure_future(awaitable)
+        while not task.done():
+            if self.stopping.is_set():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return False
+            await asyncio.wait([task], timeout=poll_interval)
+        return True
+
+    async def crawl(self, max_num_books, max_num_reviews, records, searches=None):
+        '''Pages through the search results and queues a review job for every book as soon as it is parsed'''
+        # every blocking call runs in a thread: a page of reviews per review worker, and for every search worker a
+        # page of results and a batch handed to the consumer, plus the batch of reviews being handed over. asyncio's
+        # default pool has min(32, cpus + 4) threads which would quietly cap the concurrency
+        num_search_workers = min(self.concurrency, len(searches)) if searches else 1
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.concurrency + 2 * num_search_workers + 1,
+                               thread_name_prefix="crawl"))
+        jobs = asyncio.Queue()
+        order = BookOrderBuffer()
+        emitting = asyncio.Lock()
+        workers = [asyncio.create_task(self.review_worker(jobs, order, emitting, records, max_num_reviews))
+                   for _ in range(self.concurrency)]
+        workers.append(asyncio.create_task(self.retry_worker(jobs)))
+
+        # the books found so far by every search
+        self.num_books = 0
+        try:
+            # the books a resumed run left unfinished were listed before the pages it got to, so they are queued
+            # before paging carries on. they count towards the quota
+            for book_card, book, last_review_page_url, resumed in self.crawler.iter_unfinished_books():
+                self.num_books += 1
+                await self.queue_book(book_card, book, last_review_page_url, resumed, jobs, order, records,
+                                      max_num_reviews)
+
+            if searches is None:
+                await self.until_stopped(self.crawl_search(None, self.crawler.current_url, self.crawler.page_source,
+                                                           jobs, order, records, max_num_books, max_num_reviews))
+            else:
+                # the searches are shared out between as many search workers as there are review workers, their
+                # pages all go through the same rate limit
+                pending = asyncio.Queue()
+                for search in searches:
+                    pending.put_nowait(search)
+                await self.until_stopped(asyncio.gather(*[self.search_worker(pending, jobs, order, records,
+                                                                             max_num_books, max_num_reviews)
+                                                          for _ in range(num_search_workers)]))
+
+            # the workers are cancelled as soon as the consumer stops instead of going through the queue
+            while await self.until_stopped(jobs.join()):
+                # blocked books may still be waiting out their backoff
+                if not len(self.retries):
+                    break
+                await asyncio.sleep(max(self.retries.wait_time() or 0, 0.1))
+        except Exception as e:
+            logger.warning("Something went wrong while getting books: %s", e)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            records.put(None)
+
+    async def search_worker(self, pending, jobs, order, records, max_num_books, max_num_reviews):
+        '''Takes searches off the queue and pages through their results until there are none left'''
+        while not pending.empty() and self.num_books < max_num_books and not self.stopping.is_set():
+            search = pending.get_nowait()
+            logger.info("Searching %s...", search.name)
+            try:
+                url, page_source = await asyncio.to_thread(self.crawler.fetch_retrying, search.start_url())
+                await self.crawl_search(search, url, page_source, jobs, order, records, max_num_books,
+                                        max_num_reviews)
+            except Exception as e:
+                # the other searches carry on, a resumed crawl picks this one up from the last page it got to
+                logger.warning("Something went wrong while searching %s: %s", search.name, e)
+
+    async def crawl_search(self, search, url, page_source, jobs, order, records, max_num_books, max_num_reviews):
+        '''Pages through the results of a search from the page at url, queueing a review job for every book it lists
+        that no other search listed before'''
+        query = search.name if search is not None else None
+        max_search_books = search.max_books if search is not None and search.max_books else max_num_books
+        if search is not None and search.max_reviews:
+            max_num_reviews = search.max_reviews
+        search_books = 0
+        while self.num_books < max_num_books and search_books < max_search_books and not self.stopping.is_set():
+            # when resuming, books finished by a previous run are skipped and unfinished ones carry on
+            for book_card, book, last_review_page_url, resumed in self.crawler.iter_page_books(query, page_source,
+                                                                                               url):
+                # counted before we wait on the consumer, so the other searches see this book towards the quota
+                self.num_books += 1
+                search_books += 1
+                await self.queue_book(book_card, book, last_review_page_url, resumed, jobs, order, records,
+                                      max_num_reviews)
+
+                if self.num_books >= max_num_books or search_books >= max_search_books:
+                    break
+            await self.emit(records, list(self.crawler.listings.records()))
+
+            if self.num_books >= max_num_books or search_books >= max_search_books:
+                break
+            next_url = self.crawler.parse(parsers.parse_next_book_page_url, page_source, url)
+            if next_url is None or (search is not None and not search.has_next_page(url)):
+                # every page of results of the search was crawled
+                if search is not None and self.crawler.state is not None:
+                    self.crawler.state.set_meta(search.done_key, True)
+                break
+            try:
+                # the next search page goes through the same rate limit as the review pages
+                url, page_source = await asyncio.to_thread(self.crawler.fetch_retrying, next_url)
+            except Exception as e:
+                # the books found so far still get their reviews
+                logger.warning("Something went wrong while navigating to the next page: %s", e)
+                break
+            logger.info("Going to next page...")
+            if self.crawler.state is not None:
+                self.crawler.state.set_meta(search.frontier_key if search is not None else "frontier_url", url)
+
+    async def queue_book(self, book_card, book, last_review_page_url, resumed, jobs, order, records,
+                         max_num_reviews):
+        '''Hands a new book to the consumer and queues the review job of a book that has reviews, once there is room
+        for it behind the first unfinished book'''
+        while len(order) >= self.max_books_ahead and not self.stopping.is_set():
+            await asyncio.sleep(0.1)
+        # a resumed book was already written out by the run that found it
+        batch = [] if resumed else self.crawler.book_records(book)
+        if not book_card["reviews_url"]:
+            batch.append(self.crawler.checkpoint(self.crawler.finish_book, book.id))
+        await self.emit(records, batch)
+
+        if book_card["reviews_url"]:
+            order.expect(book.id)
+            jobs.put_nowait((book.id, book_card["reviews_url"],
+                             self.crawler.remaining_reviews(book.id, max_num_reviews, resumed),
+                             last_review_page_url, self.crawler.known_reviews(book.id, book_card)))
+
+    async def retry_worker(self, jobs):
+        '''Puts blocked review jobs back in the queue once their backoff is over, until it is cancelled'''
+        while True:
+            for job in self.retries.pop_ready():
+                jobs.put_nowait(job)
+            wait_time = self.retries.wait_time()
+            await asyncio.sleep(1.0 if wait_time is None else min(wait_time, 1.0))
+
+    async def review_worker(self, jobs, order, emitting, records, max_num_reviews):
+        '''Takes review jobs off the queue until it is cancelled. The pages of a book's reviews are fetched one at a
+        time and handed over as they come, each with its checkpoint'''
+        while True:
+            job = await jobs.get()
+            book_id, reviews_url, max_num_reviews, last_review_page_url, known = job
+            done = False
+            retrying = False
+            try:
+                logger.info("Getting reviews for book %s", book_id)
+                pages = self.crawler.iter_review_pages(reviews_url, max_num_reviews, last_review_page_url, known)
+                while (page := await asyncio.to_thread(next, pages, None)) is not None:
+                    last_review_page_url, reviews_fields = page
+                    max_num_reviews -= len(reviews_fields)
+                    order.add_page(book_id, last_review_page_url, reviews_fields)
+                    await self.emit_ready(order, emitting, records)
+                done = True
+            except PageBlocked as blocked:
+                # the retry carries on after the last page that went through
+                retry_job = (book_id, reviews_url, max_num_reviews, last_review_page_url, known)
+                delay = self.retries.push(book_id, retry_job)
+                retrying = delay is not None
+                if retrying:
+                    logger.warning("%s, trying book %s again in %.0fs", blocked, book_id, delay)
+                else:
+                    # the pages that went through are kept, a resumed run carries on after them
+                    logger.error("%s, giving up on book %s for this run", blocked, book_id)
+            except Exception as e:
+                logger.warning("Something went wrong while getting reviews: %s", e)
+            finally:
+                # a book that is tried again later isn't finished yet, the retry worker puts it back in the queue
+                if not retrying:
+                    order.finish(book_id, done)
+                    await self.emit_ready(order, emitting, records)
+                jobs.task_done()
@@ -0,0 +1,201 @@
+'''Writes books and reviews to disk as they are scraped'''
+import csv
+import json
+import os
+
+from records import BOOK_FIELDS, BOOK_QUERY_FIELDS, REVIEW_FIELDS
+
+
+class Sink:
+    '''Base class for a writer that receives ("book", book) and ("review", review) records one at a time.
+
+    ("checkpoint", checkpoint) records are functions that save the crawl's progress. They are called once every
+    record written before them is on disk, so a resumed crawl never skips what the interrupted one didn't write.
+    The records before a checkpoint are held back until it comes and written along with it, so the rows of a page
+    never reach disk without their checkpoint. The ones left without a checkpoint on close are dropped and scraped
+    again by the resumed crawl. Records that have no checkpoints, like those of a conversion, are written right
+    away when checkpointed is False.
+    '''
+
+    def __init__(self, flush_every=100, checkpointed=True):
+        # records are flushed to disk regularly so the files can be read while the crawl is still going. sinks that
+        # manage their own batches pass None
+        self.flush_every = flush_every
+        self.checkpointed = checkpointed
+        self.unflushed = 0
+        self.checkpoints = []
+        # the records written since the last checkpoint
+        self.uncommitted = []
+
+    def write(self, kind, record):
+        '''Writes a record and flushes every few records'''
+        if kind != "checkpoint":
+            if self.checkpointed:
+                self.uncommitted.append((kind, record))
+            else:
+                self.write_record(kind, record)
+            return
+        uncommitted, self.uncommitted = self.uncommitted, []
+        for uncommitted_kind, uncommitted_record in uncommitted:
+            self.write_record(uncommitted_kind, uncommitted_record)
+        self.checkpoints.append(record)
+        if self.flush_every is not None:
+            # flushing the files is cheap so the checkpoint is made right away, a resumed crawl then doesn't
+            # write again what was written after the last one
+            self.sync()
+            self.unflushed = 0
+
+    def write_record(self, kind, record):
+        '''Passes a book, review or listing on to the sink's writer and flushes every few records'''
+        if kind == "book":
+            self.write_book(record)
+        elif kind == "review":
+            self.write_review(record)
+        else:
+            self.write_book_query(record)
+
+        self.unflushed += 1
+        if self.flush_every is not None and self.unflushed >= self.flush_every:
+            self.sync()
+            self.unflushed = 0
+
+    def write_book(self, book):
+        '''Writes a single book'''
+        raise NotImplementedError
+
+    def write_review(self, review):
+        '''Writes a single review'''
+        raise NotImplementedError
+
+    def write_book_query(self, book_query):
+        '''Writes which search listed a book'''
+        raise NotImplementedError
+
+    def flush(self):
+        '''Pushes everything written so far to disk'''
+        pass
+
+    def sync(self):
+        '''Flushes, then makes the checkpoints of the records that were flushed'''
+        self.flush()
+        checkpoints, self.checkpoints = self.checkpoints, []
+        for checkpoint in checkpoints:
+            checkpoint()
+
+    def close(self):
+        '''Flushes and closes the files of the sink'''
+        # the checkpoint of these never came, the crawl was stopped in the middle of a page
+        self.uncommitted = []
+        self.sync()
+
+
+def shared_checkpoint(checkpoint, num_sinks):
+    '''Returns a checkpoint to write to each of num_sinks sinks that is only made once the last of them made it'''
+    remaining = [num_sinks]
+
+    def made_by_sink():
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            checkpoint()
+    return made_by_sink
+
+
+def open_output(path, append):
+    '''Opens a file to add rows to it, emptying it first unless we are appending to a resumed crawl'''
+    return open(path, "a" if append else "w", newline="", encoding="utf-8")
+
+
+class CsvSink(Sink):
+    '''Writes books to books/books.csv and reviews either to one file per book (reviews/book_{id}_reviews.csv)
+    or to a single reviews/reviews.csv where the reviews of each book follow each other'''
+
+    def __init__(self, books_dir, reviews_dir, single_reviews_file=False, append=False, flush_every=100):
+        super().__init__(flush_every)
+        self.reviews_dir = reviews_dir
+        self.single_reviews_file = single_reviews_file
+        self.append = append
+
+        self.books_file, self.books_writer = self.open_csv(os.path.join(books_dir, "books.csv"), BOOK_FIELDS)
+        self.book_queries_file, self.book_queries_writer = self.open_csv(os.path.join(books_dir, "book_queries.csv"),
+                                                                         BOOK_QUERY_FIELDS)
+        if single_reviews_file:
+            self.reviews_file, self.reviews_writer = self.open_csv(os.path.join(reviews_dir, "reviews.csv"),
+                                                                   REVIEW_FIELDS)
+        else:
+            # the reviews of a book are written one after the other so we only keep the current book's file open
+            self.reviews_file, self.reviews_writer = None, None
+            self.reviews_book_id = None
+            # a book blocked by amazon gets the rest of its reviews after other books, so its file is opened again
+            self.opened_book_ids = set()
+
+    def open_csv(self, path, fields, append=None):
+        '''Opens a csv file and writes its header unless rows are being added to an existing file'''
+        append = self.append if append is None else append
+        file = open_output(path, append)
+        writer = csv.writer(file)
+        if file.tell() == 0:
+            writer.writerow(fields)
+        return file, writer
+
+    def write_book(self, book):
+        # records hold their fields in the order of the header
+        self.books_writer.writerow(book.to_row())
+
+    def write_review(self, review):
+        if not self.single_reviews_file and review.book_id != self.reviews_book_id:
+            if self.reviews_file is not None:
+                self.reviews_file.close()
+            path = os.path.join(self.reviews_dir, f'book_{review.book_id}_reviews.csv')
+            # a book's file only exists already if a resumed crawl is adding the rest of its reviews, or if this run
+            # wrote its first pages before amazon blocked it
+            append = self.append or review.book_id in self.opened_book_ids
+            self.reviews_file, self.reviews_writer = self.open_csv(path, REVIEW_FIELDS, append=append)
+            self.opened_book_ids.add(review.book_id)
+            self.reviews_book_id = review.book_id
+        self.reviews_writer.writerow(review.to_row())
+
+    def write_book_query(self, book_query):
+        self.book_queries_writer.writerow(book_query.to_row())
+
+    def flush(self):
+        self.books_file.flush()
+        self.book_queries_file.flush()
+        if self.reviews_file is not None:
+            self.reviews_file.flush()
+
+    def close(self):
+        super().close()
+        self.books_file.close()
+        self.book_queries_file.close()
+        if self.reviews_file is not None:
+            self.reviews_file.close()
+
+
+class JsonLinesSink(Sink):
+    '''Writes one JSON object per line to books/books.jsonl and reviews/reviews.jsonl'''
+
+    def __init__(self, books_dir, reviews_dir, append=False, flush_every=100):
+        super().__init__(flush_every)
+        self.books_file = open_output(os.path.join(books_dir, "books.jsonl"), append)
+        self.reviews_file = open_output(os.path.join(reviews_dir, "reviews.jsonl"), append)
+        self.book_queries_file = open_output(os.path.join(books_dir, "book_queries.jsonl"), append)
+
+    def write_book(self, book):
+        self.books_file.write(json.dumps(book.to_dict()) + "\n")
+
+    def write_review(self, review):
+        self.reviews_file.write(json.dumps(review.to_dict()) + "\n")
+
+    def write_book_query(self, book_query):
+        self.book_queries_file.write(json.dumps(book_query.to_dict()) + "\n")
+
+    def flush(self):
+        self.books_file.flush()
+        self.reviews_file.flush()
+        self.book_queries_file.flush()
+
+    def close(self):
+        super().close()
+        self.books_file.close()
+        self.reviews_file.close()
+        self.book_queries_file.close()
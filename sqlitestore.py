@@ -0,0 +1,15 @@
+'''Opens the SQLite files the crawl keeps its progress, indexes and page cache in'''
+import sqlite3
+import threading
+
+
+def open_sqlite(path, schema):
+    '''Opens a SQLite file and creates the tables of the given schema if needed. Returns the connection and the lock
+    to hold while using it, since the http engine uses the stores from several threads at once'''
+    connection = sqlite3.connect(path, check_same_thread=False)
+    with connection:
+        # the write-ahead log makes every small commit an append instead of a rewrite of the database
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(schema)
+    return connection, threading.Lock()
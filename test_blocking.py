@@ -0,0 +1,77 @@
+'''Checks that the captcha, robot check and throttling pages stored in bench_corpus/blocked/ are told apart from the
+pages we scrape, and that blocked jobs back off the way they should'''
+import os
+
+import pytest
+
+from blocking import CAPTCHA, OK, ROBOT_CHECK, THROTTLED, RetryQueue, classify_page
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_corpus")
+
+
+def read_page(*path):
+    '''Returns the html of a page of the corpus'''
+    with open(os.path.join(CORPUS_DIR, *path), encoding="utf-8") as page_file:
+        return page_file.read()
+
+
+@pytest.mark.parametrize("name, status_code, kind", [
+    ("captcha.html", 200, CAPTCHA),
+    ("robot_check.html", 503, ROBOT_CHECK),
+    ("robot_check.html", 200, ROBOT_CHECK),
+    ("throttled.html", 503, THROTTLED),
+    ("throttled.html", 200, THROTTLED),
+])
+def test_blocked_pages(name, status_code, kind):
+    assert classify_page(read_page("blocked", name), status_code) == kind
+
+
+@pytest.mark.parametrize("name", ["search_1.html", "product.html", "reviews_1.html"])
+def test_scraped_pages(name):
+    assert classify_page(read_page(name)) == OK
+
+
+def test_review_quoting_a_block_page():
+    # a review can say anything, the page is still the one we asked for
+    quote = ("Sorry, we just need to make sure you're not a robot. Enter the characters you see below. "
+             "Request was throttled.")
+    page = read_page("reviews_1.html").replace("</body>", f"<span class=\"review-text\">{quote}</span></body>")
+    assert classify_page(page) == OK
+
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_throttled_status(status_code):
+    assert classify_page(read_page("reviews_1.html"), status_code) == THROTTLED
+
+
+def test_backoff_doubles_up_to_max_delay():
+    retries = RetryQueue(base_delay=10, max_delay=60)
+    for attempt, delay in [(1, 10), (2, 20), (3, 40), (4, 60), (10, 60)]:
+        for _ in range(20):
+            # randomized between half the delay and the delay so blocked jobs don't all come back at once
+            assert delay / 2 <= retries.backoff(attempt) <= delay
+
+
+def test_gives_up_after_max_attempts():
+    retries = RetryQueue(base_delay=0, max_attempts=3)
+    for _ in range(3):
+        assert retries.push("book", "job") is not None
+    assert retries.push("book", "job") is None
+    # other jobs have attempts of their own
+    assert retries.push("other book", "other job") is not None
+
+
+def test_jobs_come_back_once_their_backoff_is_over():
+    retries = RetryQueue(base_delay=0)
+    retries.push(1, "first")
+    retries.push(2, "second")
+    assert len(retries) == 2
+    assert retries.wait_time() == 0
+    assert retries.pop_ready() == ["first", "second"]
+    assert len(retries) == 0
+    assert retries.wait_time() is None
+
+    retries = RetryQueue(base_delay=3600)
+    retries.push(1, "later")
+    assert retries.pop_ready() == []
+    assert retries.wait_time() > 0
@@ -0,0 +1,44 @@
+'''Conditions that tell when a page is ready, so the crawler waits exactly as long as a page needs instead of a
+fixed number of seconds. They are used like selenium's expected_conditions, with WebDriverWait'''
+import time
+
+from selenium.common.exceptions import StaleElementReferenceException
+
+# asks the browser in a single round-trip whether the page finished loading and how many resources it fetched so far
+PAGE_LOAD_STATE = "return [document.readyState, performance.getEntriesByType('resource').length];"
+
+
+def network_idle(quiet_period=0.5):
+    '''The page finished loading and hasn't fetched anything new (images, lazy loaded reviews...) for quiet_period
+    seconds'''
+    last = {"resources": None, "changed_at": time.monotonic()}
+
+    def _predicate(driver):
+        ready_state, resources = driver.execute_script(PAGE_LOAD_STATE)
+        now = time.monotonic()
+        if ready_state != "complete" or resources != last["resources"]:
+            last["resources"] = resources
+            last["changed_at"] = now
+            return False
+        return now - last["changed_at"] >= quiet_period
+
+    return _predicate
+
+
+def page_changed(old_element, previous_url, quiet_period=0.5):
+    '''The page moved on from the one we were on: the element we knew from it (the first review or book card) was
+    removed from the document. When there was no element to watch we settle for the url changing (amazon puts the
+    pageNumber in it) or, failing that, for the network going idle'''
+    idle = network_idle(quiet_period)
+
+    def _predicate(driver):
+        if old_element is not None:
+            try:
+                # any call on an element that was removed from the document raises
+                old_element.is_enabled()
+                return False
+            except StaleElementReferenceException:
+                return True
+        return driver.current_url != previous_url or idle(driver)
+
+    return _predicate
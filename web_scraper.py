@@ -1,63 +1,427 @@
+import functools
+import itertools
+import logging
 import re
-import csv
 import os
+import sys
 import time
-from argparse import ArgumentParser
+import weakref
+from argparse import ArgumentParser, BooleanOptionalAction
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service as ChromeService
 
-from webdriver_manager.chrome import ChromeDriverManager
+import parsers
+from checkpoint import CrawlState, book_key, resume_unfinished_books
+from crawler_pool import CrawlerPool
+from drivers import create_chrome_driver, quit_driver, resolve_driver_path
+from book_index import BookIndex
+from blocking import MAX_BLOCK_PAGE_SIZE, OK, BlockTracker, PageBlocked, RetryQueue, classify_page, next_user_agent
+from fetcher import HttpFetcher
+from jobs import BookListings, SearchJob, load_jobs, start_listed_book
+from pagecache import PageCache
+from records import Book, Review
+from review_index import ReviewIndex, is_known_page
+from sinks import CsvSink, JsonLinesSink, shared_checkpoint
+from metrics import LOG_FORMAT, Metrics, ProgressReporter, instrument_driver
+from scheduler import AsyncCrawlScheduler, BookOrderBuffer, RateLimiter, ThroughputCounter
+from waits import page_changed
+
+logger = logging.getLogger(__name__)
+
+AMAZON_BOOKS_SEARCH_URL = "https://www.amazon.com/s?k=best+seller+books+2022&i=stripbooks&sprefix=best%2Cstripbooks%2C69&ref=nb_sb_ss_ts-doa-p_1_4"
+
+# returns the html of a page only if it is small enough to be a captcha, robot check or throttling page. the pages
+# we scrape are much bigger so checking them doesn't cost sending them over
+SMALL_PAGE_SOURCE = ("const html = document.documentElement.outerHTML; "
+                     f"return html.length < {MAX_BLOCK_PAGE_SIZE} ? html : '';")
+
+# how often the waits check whether the page is ready. selenium's default of half a second is most of the time
+# an already loaded page spends waiting
+WAIT_POLL_FREQUENCY = 0.1
+
+
+def set_query_params(url, **params):
+    '''Returns the url with the given query parameters added or replaced'''
+    scheme, netloc, path, query, _ = urlsplit(url)
+    query_params = [(key, value) for key, value in parse_qsl(query) if key not in params]
+    query_params += [(key, str(value)) for key, value in params.items()]
+    return urlunsplit((scheme, netloc, path, urlencode(query_params), ""))
+
+
+class Crawler:
+    '''Base class of the crawlers of amazon's books. It numbers, checkpoints and indexes the books and reviews the
+    selenium and http engines scrape, and pages lazily through them for iter_books and iter_reviews. The engines
+    provide the pages: iter_page_books, go_to_next_book_page and iter_review_pages'''
+
+    def __init__(self, metrics=None, rate_limiter=None, retries=None, rotate_after=3, state=None, review_index=None,
+                 book_index=None, next_book_id=1, next_review_id=1):
+        # used to generate IDs for the scraped books so we can tie them to their reviews, and for the scraped
+        # reviews. a resumed crawl carries on from the IDs of the one it resumes
+        self.next_book_id = next_book_id
+        self.next_review_id = next_review_id
+        # every page, wait and parse is counted and timed
+        self.metrics = metrics or Metrics()
+        # every page goes through the rate limiter so amazon doesn't make us solve a captcha
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # pages amazon blocked are tried again after an exponential backoff
+        self.retries = retries if retries is not None else RetryQueue()
+        # counts the pages amazon blocked. after rotate_after blocks in a row the session is replaced
+        self.blocks = BlockTracker(self.metrics, rotate_after)
+        # when a CrawlState is given every book and page of reviews is checkpointed so the crawl can be resumed
+        self.state = state
+        # when a ReviewIndex is given the crawl is incremental: only reviews not scraped by an earlier crawl are kept
+        self.review_index = review_index
+        # when a BookIndex is given books keep their ID across crawls and the ones scraped recently are skipped
+        self.book_index = book_index
+        self.book_keys = {}
+        # the cards of the books iter_books passed on, until iter_reviews scrapes their reviews or the book is let go
+        self.book_cards = {}
+        # books listed by several searches are only scraped once, and mapped to every search that listed them
+        self.listings = BookListings(state)
+
+    def wait_for_rate_limit(self):
+        '''Blocks until the rate limiter lets the next page through'''
+        with self.metrics.timer("rate_limit"):
+            self.rate_limiter.acquire()
+
+    def parse(self, parser, *args):
+        '''Runs one of the parsers on a page'''
+        with self.metrics.timer("parse"):
+            return parser(*args)
+
+    def iter_page_books(self, query=None):
+        '''Yields the card, book, last page of reviews saved and whether it was resumed of every book left to scrape
+        on the current page of results'''
+        raise NotImplementedError
 
-class WebCrawler:
-    '''Base Class for a web crawler'''
-
-    def __init__(self, url, driver):
-        self.url = url
-        self.driver = driver
-        self.driver.get(self.url)
-
-    def wait(self, seconds=5):
-        '''Wait for the specified amount of time'''
-
-        self.driver.implicitly_wait(seconds)
+    def go_to_next_book_page(self):
+        '''Moves to the next page of results. Returns whether there was one'''
+        raise NotImplementedError
+
+    def iter_unfinished_books(self):
+        '''Yields the card, book, last page of reviews saved and whether it was resumed of every book the run being
+        resumed left unfinished. They were listed before the page of results it got to, so they come first'''
+        if self.state is None:
+            return
+        for book_card, book, last_review_page_url, resumed in resume_unfinished_books(self.state):
+            # a search listing it again only maps it to that search
+            self.listings.book_ids[book_key(book_card)] = book.id
+            yield book_card, book, last_review_page_url, resumed
 
-    def wait_until(self, until):
-        '''Waits a set amount of time for a web driver until event'''
+    def scroll_to_bottom(self):
+        '''Makes sure everything lazy loaded is in the page'''
+        pass
 
-        WebDriverWait(self.driver, 10).until(until)
+    def iter_review_pages(self, reviews_url, max_num_reviews, last_review_page_url=None, known=None):
+        '''Yields the url and reviews of every page of a book's reviews'''
+        raise NotImplementedError
+
+    def new_book(self, book_card):
+        '''Turns the fields extracted from a book card into a book with the next book ID'''
+        if self.book_index is not None:
+            # a book seen by an earlier crawl keeps its ID and gets its price, ratings and reviews count updated
+            return self.book_index.new_book(book_key(book_card), book_card)
+        book = Book(self.next_book_id, book_card["title"], book_card["authors"], book_card["price"],
+                    book_card["ratings"], book_card["num_reviews"])
+        self.next_book_id += 1
+        return book
+
+    def new_reviews(self, book_id, reviews_fields):
+        '''Numbers the reviews extracted from a book's reviews pages with the next review IDs'''
+        for review in reviews_fields:
+            review.id = self.next_review_id
+            review.book_id = book_id
+            self.next_review_id += 1
+        return reviews_fields
+
+    def number_reviews(self, book_id, reviews_fields):
+        '''Numbers the reviews scraped from a page (or all the pages) of a book's reviews'''
+        if self.review_index is not None:
+            # reviews scraped by an earlier crawl are left out and new ones get IDs that stay the same in later crawls.
+            # they are only indexed by save_reviews once they were written out
+            return self.review_index.new_reviews(self.book_keys[book_id], book_id, reviews_fields)
+        reviews = self.new_reviews(book_id, reviews_fields)
+        if self.state is not None:
+            # the IDs are taken even if the reviews don't make it to disk, so a resumed run never hands them out again
+            self.state.set_meta("next_review_id", self.next_review_id)
+        return reviews
+
+    def checkpoint(self, method, *args):
+        '''Returns a ("checkpoint", checkpoint) record that calls one of the checkpointing methods once the records
+        before it are written'''
+        return "checkpoint", functools.partial(method, *args)
+
+    def book_records(self, book):
+        '''Returns the ("book", book) record of a new book and the checkpoint that it was written'''
+        return [("book", book), self.checkpoint(self.book_written, book.id)]
+
+    def review_records(self, book_id, reviews_fields, page_url=None):
+        '''Numbers the reviews scraped from a page (or all the pages) of a book's reviews and returns their
+        ("review", review) records followed by the checkpoint of the page'''
+        reviews = self.number_reviews(book_id, reviews_fields)
+        records = [("review", review) for review in reviews]
+        records.append(self.checkpoint(self.save_reviews, book_id, reviews, page_url))
+        return records
+
+    def book_written(self, book_id):
+        '''Checkpoints that a book was written out'''
+        if self.state is not None:
+            self.state.book_written(book_id)
+
+    def index_reviews(self, book_id, reviews):
+        '''Adds reviews that were written out to the review index, so later crawls leave them out'''
+        if self.review_index is not None and reviews:
+            self.review_index.add_reviews(self.book_keys[book_id], reviews)
+
+    def save_reviews(self, book_id, reviews, page_url):
+        '''Checkpoints a page of a book's reviews that was written out, along with its reviews'''
+        self.index_reviews(book_id, reviews)
+        self.save_review_page(book_id, len(reviews), page_url)
+
+    def save_review_page(self, book_id, num_reviews, page_url):
+        '''Checkpoints a page of a book's reviews that was written out'''
+        if self.state is not None:
+            self.state.add_review_page(book_id, num_reviews, page_url)
+
+    def remaining_reviews(self, book_id, max_num_reviews, resumed):
+        '''Returns how many reviews are left to scrape for a book, leaving out the ones saved by a previous run'''
+        if resumed and self.state is not None:
+            return max_num_reviews - self.state.count_reviews(book_id)
+        return max_num_reviews
+
+    def finish_book(self, book_id):
+        '''Checkpoints that every review of a book was scraped'''
+        if self.state is not None:
+            self.state.finish_book(book_id)
+        if self.book_index is not None:
+            self.book_index.finish_book(book_id)
+
+    def known_reviews(self, book_id, book_card):
+        '''Returns the fingerprints of the reviews of a book scraped by earlier crawls, or None when the crawl isn't
+        incremental'''
+        if self.review_index is None:
+            return None
+        self.book_keys[book_id] = book_key(book_card)
+        return self.review_index.known(self.book_keys[book_id])
+
+    def iter_books(self, max_num_books=None):
+        '''Yields the books of the search results one at a time, going to the next page of results only once every
+        book of the current one was taken. Reviews are not touched, they are scraped by iter_reviews when asked for.
+        Books started by a previous run are passed on again first so their reviews can be finished'''
+        num_books = 0
+        page_books = itertools.chain(self.iter_unfinished_books(), self.iter_page_books())
+        try:
+            while max_num_books is None or num_books < max_num_books:
+                for book_card, book, last_review_page_url, resumed in page_books:
+                    # the card is only kept while the consumer holds on to the book, one that only wants books
+                    # doesn't pile them up
+                    self.book_cards[book.id] = (book_card, last_review_page_url, resumed)
+                    weakref.finalize(book, self.book_cards.pop, book.id, None)
+                    # the book is the consumer's to keep from here on
+                    self.book_written(book.id)
+                    yield book
+                    num_books += 1
+                    if max_num_books is not None and num_books >= max_num_books:
+                        return
+
+                if not self.go_to_next_book_page():
+                    return
+                logger.info("Going to next page...")
+                if self.state is not None:
+                    self.state.set_meta("frontier_url", self.current_url)
+                self.scroll_to_bottom()
+                page_books = self.iter_page_books()
+        except NoSuchElementException as e:
+            logger.warning("Could not find any books: %s", e)
+        except Exception as e:
+            logger.warning("Something went wrong while getting books: %s", e)
+
+    def iter_reviews(self, book, max_num_reviews=None):
+        '''Yields the reviews of a book passed on by iter_books, scraping the next page of reviews only once every
+        review of the current one was taken. When amazon blocks a page we wait out a backoff and carry on from the
+        last page saved. The book is finished once all its reviews (or max_num_reviews of them) were taken'''
+        if book.id not in self.book_cards:
+            raise ValueError(f"Book {book.id} wasn't passed on by iter_books, or its reviews were already taken")
+        book_card, last_review_page_url, resumed = self.book_cards.pop(book.id)
+        if not book_card["reviews_url"]:
+            self.finish_book(book.id)
+            return
+        if max_num_reviews is None:
+            max_num_reviews = sys.maxsize
+        remaining_reviews = self.remaining_reviews(book.id, max_num_reviews, resumed)
+        known = self.known_reviews(book.id, book_card)
+
+        attempt = 0
+        while True:
+            try:
+                # if the consumer stops early the pages are let go of when this generator is
+                for page_url, reviews_fields in self.iter_review_pages(book_card["reviews_url"], remaining_reviews,
+                                                                       last_review_page_url, known):
+                    last_review_page_url = page_url
+                    remaining_reviews -= len(reviews_fields)
+                    reviews = self.number_reviews(book.id, reviews_fields)
+                    for review in reviews:
+                        # a review only counts as scraped for later crawls once it is handed to the consumer
+                        self.index_reviews(book.id, [review])
+                        yield review
+                    # the page is checkpointed once the consumer has taken every review of it
+                    self.save_review_page(book.id, len(reviews), page_url)
+                break
+            except PageBlocked as blocked:
+                attempt += 1
+                if attempt > self.retries.max_attempts:
+                    logger.error("%s, giving up on book %s for this run", blocked, book.id)
+                    return
+                delay = self.retries.backoff(attempt)
+                logger.warning("%s, trying book %s again in %.0fs", blocked, book.id, delay)
+                with self.metrics.timer("backoff"):
+                    time.sleep(delay)
+        self.finish_book(book.id)
+
+
+class WebCrawler(Crawler):
+    '''Base Class for a web crawler'''
 
-    def go_to_next_book_page(self):
-        pass
+    def __init__(self, url, driver, metrics=None, rate_limiter=None, wait_timeout=10, retries=None,
+                 driver_factory=None, rotate_after=3, **books):
+        # every page goes through the rate limiter so amazon doesn't make us solve a captcha. it backs off down to a
+        # page every 20 seconds when amazon pushes back. every command sent to the browser is counted and timed,
+        # along with the waits, clicks and page loads. after rotate_after blocks in a row the browser is replaced by
+        # a new one from driver_factory, with new cookies and a new user agent
+        super().__init__(metrics, rate_limiter or RateLimiter(rate=1.0, min_rate=0.05), retries, rotate_after,
+                         **books)
+        self.url = url
+        # the longest we wait for a page to be ready before giving up on it
+        self.wait_timeout = wait_timeout
+        self.driver_factory = driver_factory
+        self.rotate_pending = False
+        self.driver = instrument_driver(driver, self.metrics)
+        if self.url:
+            try:
+                self.load(self.url)
+            except PageBlocked as blocked:
+                self.retry_page(blocked)
+
+    def wait_until(self, until, timeout=None):
+        '''Waits until a condition is met, polling it often so we carry on as soon as the page is ready'''
+
+        with self.metrics.timer("wait"):
+            return WebDriverWait(self.driver, timeout or self.wait_timeout,
+                                 poll_frequency=WAIT_POLL_FREQUENCY).until(until)
+
+    @property
+    def current_url(self):
+        '''The url of the page the browser is on'''
+        return self.driver.current_url
+
+    def check_page(self, url):
+        '''Checks whether amazon served the page we asked for and tunes the rate limiter: it speeds up a little after
+        every page that went through and slows down a lot when amazon blocks one, in which case PageBlocked is
+        raised'''
+        kind = classify_page(self.driver.execute_script(SMALL_PAGE_SOURCE) or "")
+        if kind == OK:
+            self.blocks.ok()
+            self.rate_limiter.speed_up()
+            return
+        blocked = PageBlocked(url, kind)
+        logger.warning("%s, slowing down to %.2f pages/s", blocked, self.rate_limiter.slow_down())
+        if self.blocks.blocked(kind):
+            # the browser is replaced the next time it is safe to, when no reviews tab is open
+            self.rotate_pending = True
+        raise blocked
+
+    def rotate_session(self, url):
+        '''Replaces the browser with a new one, if we know how to start one, and opens url in it'''
+        self.rotate_pending = False
+        if self.driver_factory is not None:
+            logger.warning("Blocked too many times in a row, starting a new browser")
+            quit_driver(self.driver)
+            self.driver = instrument_driver(self.driver_factory(), self.metrics)
+        self.load(url)
+
+    def rotate_if_needed(self):
+        '''Replaces the browser once amazon blocked it too many times in a row, back on the page it was on'''
+        if not self.rotate_pending:
+            return
+        url = self.driver.current_url
+        try:
+            self.rotate_session(url)
+        except PageBlocked as blocked:
+            self.retry_page(blocked)
+
+    def retry_page(self, blocked):
+        '''Waits out a growing backoff and loads a blocked page again, from a new browser once amazon blocked us too
+        many times in a row. Returns whether the page could be loaded'''
+        for attempt in range(1, self.retries.max_attempts + 1):
+            delay = self.retries.backoff(attempt)
+            logger.warning("%s, trying again in %.0fs", blocked, delay)
+            with self.metrics.timer("backoff"):
+                time.sleep(delay)
+            try:
+                if self.rotate_pending:
+                    self.rotate_session(blocked.url)
+                else:
+                    self.load(blocked.url)
+                return True
+            except PageBlocked as e:
+                blocked = e
+        logger.error("%s, giving up on it", blocked)
+        return False
 
     def click_link(self, link_el, open_in_new_tab=False):
         '''Opens a link in a new tab or in the same tab'''
-        if open_in_new_tab:
-            link_el.send_keys(Keys.COMMAND + Keys.RETURN)
-        else:
-            link_el.click()
-    
+        with self.metrics.timer("click"):
+            if open_in_new_tab:
+                link_el.send_keys(Keys.COMMAND + Keys.RETURN)
+            else:
+                link_el.click()
+
+    def load(self, url):
+        '''Opens a url in the current tab once the rate limiter allows it'''
+        self.wait_for_rate_limit()
+        with self.metrics.timer("page_load"):
+            self.driver.get(url)
+        self.check_page(url)
+
+    def follow_link(self, link_el, marker_selector):
+        '''Clicks a link once the rate limiter allows it and waits until the next page replaced the current one. The
+        first element matching marker_selector (a review or a book card) tells us the old page went away'''
+        markers = self.driver.find_elements(By.CSS_SELECTOR, marker_selector)
+        previous_url = self.driver.current_url
+        # if amazon blocks the page this is the url we try again
+        url = link_el.get_attribute("href")
+        self.wait_for_rate_limit()
+        self.click_link(link_el)
+        self.wait_until(page_changed(markers[0] if markers else None, previous_url))
+        self.check_page(url)
+
+    def open_in_new_tab(self, url):
+        '''Opens a url in a new tab and switches to it'''
+        self.driver.switch_to.new_window('tab')
+        self.load(url)
+
     def quit(self):
         '''Ends the session for the crawler'''
         self.driver.quit()
 
 
 class AmazonBooksWebCrawler(WebCrawler):
-    # used to generate IDs for the scraped books so we can tie them to their reviews
-    next_book_id = 1
-
-    # used to generate IDs for the scraped reviews
-    next_review_id = 1
-
-    def __init__(self, driver):
-        url = "https://www.amazon.com/s?k=best+seller+books+2022&i=stripbooks&sprefix=best%2Cstripbooks%2C69&ref=nb_sb_ss_ts-doa-p_1_4"
-        super().__init__(url, driver)
+    def __init__(self, driver, extraction="snapshot", url=AMAZON_BOOKS_SEARCH_URL, review_pool=None, state=None,
+                 review_index=None, rate_limiter=None, wait_timeout=10, metrics=None, retries=None,
+                 driver_factory=None, rotate_after=3, next_book_id=1, next_review_id=1, book_index=None):
+        # "snapshot" parses the page source once per page, "selenium" queries the driver for every field
+        self.extraction = extraction
+        # when a CrawlerPool is given the reviews are scraped by its workers instead of in a tab of this driver
+        self.review_pool = review_pool
+        self.review_order = BookOrderBuffer()
+        super().__init__(url, driver, metrics, rate_limiter, wait_timeout, retries, driver_factory, rotate_after,
+                         state=state, review_index=review_index, book_index=book_index, next_book_id=next_book_id,
+                         next_review_id=next_review_id)
 
 
     def has_next_book_page(self):
@@ -96,13 +460,16 @@ class AmazonBooksWebCrawler(WebCrawler):
             # if the next button is not disabled then click it to navigate to the next page
             is_disabled = 's-pagination-disabled' in next_button.get_attribute("class").split()
             if not is_disabled:
-                next_button.click()
+                self.follow_link(next_button, ".sg-col-inner > .s-widget-container")
                 return True
             else:
                 return False
+        except PageBlocked as blocked:
+            # we wait and load the page again rather than ending the crawl on a captcha
+            return self.retry_page(blocked)
         except Exception as e:
             # handle any errors that might occur so the program doesn't stop
-            print("Something went wrong while navigating to the next page", e)
+            logger.warning("Something went wrong while navigating to the next page: %s", e)
             return False
 
 
@@ -115,13 +482,16 @@ class AmazonBooksWebCrawler(WebCrawler):
             # if the next button is not disabled then click it to navigate to the next page
             is_disabled = 'a-disabled' in next_button.get_attribute("class").split()
             if not is_disabled:
-                next_button.click()
+                self.follow_link(next_button, "div.a-section.review")
                 return True
             else:
                 return False
+        except PageBlocked:
+            # the book is put in the retry queue by the caller
+            raise
         except Exception as e:
             # handle any errors that might occur so the program doesn't stop
-            print("Something went wrong while navigating to the next page", e)
+            logger.warning("Something went wrong while navigating to the next page: %s", e)
             return False
     
 
@@ -130,274 +500,621 @@ class AmazonBooksWebCrawler(WebCrawler):
         self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
 
-    def get_books_and_reviews(self, max_num_books=100, max_num_reviews=1000):
-        '''Scrapes the books from the page'''
+    def extract(self, parser, extract_with_selenium, with_url=False):
+        '''Runs a parser on a snapshot of the current page, passing it the page's url as well with with_url. Falls back
+        to extract_with_selenium when the extraction isn't "snapshot" or the snapshot can't be parsed'''
+        if self.extraction == "snapshot":
+            try:
+                # a single round-trip for the whole page instead of several for every book or review
+                self.metrics.incr("pages")
+                if with_url:
+                    return self.parse(parser, self.driver.page_source, self.driver.current_url)
+                return self.parse(parser, self.driver.page_source)
+            except Exception as e:
+                logger.warning("Could not parse the page snapshot, falling back to selenium: %s", e)
+        with self.metrics.timer("extract"):
+            return extract_with_selenium()
+
+
+    def extract_book_cards(self):
+        '''Extracts the fields of every book card on the current page'''
+        return self.extract(parsers.parse_books, self.extract_book_cards_with_selenium, with_url=True)
+
+
+    def extract_book_cards_with_selenium(self):
+        '''Extracts the fields of every book card on the current page one element at a time'''
+        book_cards = []
+
+        # find all book elements on the page
+        book_elements = self.driver.find_elements(By.CSS_SELECTOR, ".sg-col-inner > .s-widget-container")
+        for el in book_elements:
+            try:
+                # try to extract the title and author information
+                title_authors_el = el.find_element(By.CLASS_NAME, "s-title-instructions-style")
+
+                # the title and author are usually separated by a new line so we can split to get each one
+                title_authors = title_authors_el.text.split('\n')
+
+                # sometimes the additional metadata comes before the title and author also separated by newlines
+                # but the title and author are always the last two lines so we retrieve them from the end of the list
+                title = title_authors[-2].strip()
+
+                # author information can usually be found after the word "by" or after "Book x of x" so we split
+                # the author line and take the last part to get the author information
+                authors = re.split(r'by|Book \d+ of \d+:', title_authors[-1])[1].strip()
+            except NoSuchElementException:
+                # if we can't find author or title information for some reason then we default them to empty strings
+                logger.debug("Could not find authors and title")
+                title = ""
+                authors = ""
+
+            try:
+                # try to extract the price information
+                price_el = el.find_element(By.CSS_SELECTOR, "span.a-price > span.a-offscreen").get_attribute("innerHTML")
+
+                # do some preprocessing to get it as a float
+                price = float(price_el.replace("$", ""))
+            except NoSuchElementException:
+                # if we fail to find price information then we default it as None. We don't use 0.0 because some books
+                # are actually priced at 0.0 and we want to represent the absence of an entry.
+                logger.debug("Could not find pricing information")
+                price = None
+
+            try:
+                # try to extract the ratings information. This rating represents the number of stars a book has been given.
+                ratings_el = el.find_element(By.CSS_SELECTOR, "span.a-icon-alt")
+
+                # do some preprocessing to get the number of stars a float
+                ratings = float(ratings_el.get_attribute("innerHTML").split(" ")[0])
+            except NoSuchElementException:
+                # if we fail to find ratings then default it as None instead of 0.0 to represent the absence of an
+                # entry
+                logger.debug("Could not find ratings information")
+                ratings = None
+
+            try:
+                # try to extract the number of reviews
+                num_reviews_el = el.find_element(By.CSS_SELECTOR, "div.s-title-instructions-style + div.a-section > div.a-row > span:nth-child(2)")
+
+                # do some preprocessing to get the number of reviews as an integer
+                num_reviews = int(num_reviews_el.text.replace(",", ""))
+
+                # find the url that takes us to the reviews section for the current book
+                reviews_url = num_reviews_el.find_element(By.CSS_SELECTOR, "a").get_attribute("href")
+            except NoSuchElementException:
+                # if we fail to find any reviews then default as None to represent the absence of an entry
+                logger.debug("Could not find number of reviews")
+                num_reviews = None
+                reviews_url = None
+
+            book_cards.append({
+                "title": title,
+                "authors": authors,
+                "price": price,
+                "ratings": ratings,
+                "num_reviews": num_reviews,
+                "reviews_url": reviews_url,
+            })
+        return book_cards
+
+
+    def start_search(self, url):
+        '''Opens the first page of results of a search. Returns whether it could be loaded'''
+        try:
+            self.load(url)
+            return True
+        except PageBlocked as blocked:
+            return self.retry_page(blocked)
+
+
+    def crawl_searches(self, searches, max_num_books=100, max_num_reviews=1000):
+        '''Goes through the results of every search one after the other, yielding ("book", book), ("review", review)
+        and ("book_query", book_query) records. A book listed by several searches is scraped once and mapped to each
+        of them'''
+        num_books = 0
+        for search in searches:
+            if num_books >= max_num_books:
+                break
+            logger.info("Searching %s...", search.name)
+            if not self.start_search(search.start_url()):
+                continue
+            max_search_books = min(max_num_books - num_books, search.max_books or sys.maxsize)
+            search_reviews = search.max_reviews or max_num_reviews
+            search_books = 0
+            while True:
+                for kind, record in self.get_books_and_reviews(max_search_books - search_books, search_reviews,
+                                                               search.name):
+                    if kind == "book":
+                        search_books += 1
+                    yield kind, record
+
+                if search_books >= max_search_books:
+                    break
+                if not self.has_next_book_page() or not search.has_next_page(self.driver.current_url):
+                    # every page of results of the search was scraped
+                    if self.state is not None:
+                        self.state.set_meta(search.done_key, True)
+                    break
+                # navigate to the next page of books. this waits until the old books are gone and for the rate
+                # limiter, which slows us down so Amazon doesn't make us solve a captcha
+                if not self.go_to_next_book_page():
+                    break
+                logger.info("Going to next page...")
+                if self.state is not None:
+                    self.state.set_meta(search.frontier_key, self.driver.current_url)
+                # scroll to the bottom of the page to make sure everything is lazy loaded in
+                self.scroll_to_bottom()
+            num_books += search_books
+
+
+    def get_books_and_reviews(self, max_num_books=100, max_num_reviews=1000, query=None, books=None):
+        '''Scrapes the books from the page, or the books given like iter_page_books yields them, yielding
+        ("book", book) and ("review", review) records as soon as they are scraped'''
+        num_books = 0
         try:
-            books = []
-            book_reviews = {}
-            # wait until the book elements are visible
-            self.wait_until(EC.visibility_of_all_elements_located((By.CSS_SELECTOR, ".sg-col-inner > .s-widget-container")))
-            
-            # find all book elements on the page
-            book_elements = self.driver.find_elements(By.CSS_SELECTOR, ".sg-col-inner > .s-widget-container")
-            for el in book_elements:
-                try:
-                    # try to extract the title and author information
-                    title_authors_el = el.find_element(By.CLASS_NAME, "s-title-instructions-style")
-
-                    # the title and author are usually separated by a new line so we can split to get each one
-                    title_authors = title_authors_el.text.split('\n')
-
-                    # sometimes the additional metadata comes before the title and author also separated by newlines
-                    # but the title and author are always the last two lines so we retrieve them from the end of the list
-                    title = title_authors[-2].strip()
-
-                    # author information can usually be found after the word "by" or after "Book x of x" so we split
-                    # the author line and take the last part to get the author information
-                    authors = re.split(r'by|Book \d+ of \d+:', title_authors[-1])[1].strip()
-                except NoSuchElementException:
-                    # if we can't find author or title information for some reason then we default them to empty strings
-                    print("Could not find authors and title")
-                    title = ""
-                    authors = ""
-
-                try:
-                    # try to extract the price information
-                    price_el = el.find_element(By.CSS_SELECTOR, "span.a-price > span.a-offscreen").get_attribute("innerHTML")
-
-                    # do some preprocessing to get it as a float
-                    price = float(price_el.replace("$", ""))
-                except NoSuchElementException:
-                    # if we fail to find price information then we default it as None. We don't use 0.0 because some books
-                    # are actually priced at 0.0 and we want to represent the absence of an entry.
-                    print("Could not find pricing information")
-                    price = None
-
-                try:
-                    # try to extract the ratings information. This rating represents the number of stars a book has been given.
-                    ratings_el = el.find_element(By.CSS_SELECTOR, "span.a-icon-alt")
-
-                    # do some preprocessing to get the number of stars a float
-                    ratings = float(ratings_el.get_attribute("innerHTML").split(" ")[0])
-                except NoSuchElementException:
-                    # if we fail to find ratings then default it as None instead of 0.0 to represent the absence of an
-                    # entry
-                    print("Could not find ratings information")
-                    ratings = None
-
-                try:
-                    # try to extract the number of reviews
-                    num_reviews_el = el.find_element(By.CSS_SELECTOR, "div.s-title-instructions-style + div.a-section > div.a-row > span:nth-child(2)")
-                    
-                    # do some preprocessing to get the number of reviews as an integer
-                    num_reviews = int(num_reviews_el.text.replace(",", ""))
-
-                    # find the url that takes us to the reviews section for the current book
-                    reviews_url_el = num_reviews_el.find_element(By.CSS_SELECTOR, "a")
-                    
-                    print(f"Getting reviews for book {AmazonBooksWebCrawler.next_book_id}: {title}")
-
-                    # if the book has reviews we want to scrape them as well
-                    if reviews_url_el:
-                        print("Found reviews url: ", reviews_url_el.get_attribute('href'))
-                        # open reviews in a new tab
-                        self.click_link(reviews_url_el, open_in_new_tab=True)
-                        print("Opened in new tab...")
-
-                        # switch to the new tab
-                        self.driver.switch_to.window(self.driver.window_handles[1])
-                        print("Switched to new tab...")
-
-                        # scroll to the bottom of the page just in case there is lazy loaded content
-                        self.scroll_to_bottom()
-
-                        # get all the reviews on the current page
-                        reviews = self.get_book_reviews(AmazonBooksWebCrawler.next_book_id, max_num_reviews, initial_page=True)
-                        while self.has_next_review_page() and len(reviews) < max_num_reviews:
-                            # while there is still another page of reviews and we haven't hit our limit yet...
-                            print("Getting the next page of reviews...")
-
-                            # navigate to the next review page
-                            self.go_to_next_review_page()
-
-                            # we wait for the page to load and also to limit the rate at which we access the data
-                            # if we go too fast amazon might try to have us complete a captcha.
-                            time.sleep(3)
-
-                            # scroll to the bottom again to make sure any lazy loaded content is definitely loaded in
-                            self.scroll_to_bottom()
-
-                            # grab all the reveiws and append it to the ongoing list for this book
-                            reviews += self.get_book_reviews(AmazonBooksWebCrawler.next_book_id, max_num_reviews, initial_page=False)
-
-                        # save the book reviews related to the book
-                        book_reviews[AmazonBooksWebCrawler.next_book_id] = reviews
-
-                        # close the reviews tab
-                        self.driver.close()
-
-                        # go back to the page of books
-                        self.driver.switch_to.window(self.driver.window_handles[0])
-                    else:
-                        print("No reviews for this book. Skipping...")
-                      
-                except NoSuchElementException:
-                    # if we fail to find any reviews then default as None to represent the absence of an entry
-                    print("Could not find number of reviews")
-                    num_reviews = None
-                
-                book = {
-                    "id": AmazonBooksWebCrawler.next_book_id,
-                    "title": title,
-                    "authors": authors,
-                    "price": price,
-                    "ratings": ratings,
-                    "num_reviews": num_reviews,
-                }
-                books.append(book)
-                AmazonBooksWebCrawler.next_book_id += 1
-                if len(books) >= max_num_books:
+            for book_card, book, last_review_page_url, resumed in books or self.iter_page_books(query):
+                if not resumed:
+                    # a resumed book was already written out by the run that found it
+                    yield from self.book_records(book)
+                yield from self.listings.records()
+                reviews_url = book_card["reviews_url"]
+                remaining_reviews = self.remaining_reviews(book.id, max_num_reviews, resumed)
+                known = self.known_reviews(book.id, book_card)
+
+                # if the book has reviews we want to scrape them as well
+                if reviews_url and self.review_pool is not None:
+                    # hand the reviews over to the pool and pass on the reviews of any book it has finished
+                    self.review_order.expect(book.id)
+                    self.review_pool.submit(book.id, reviews_url, remaining_reviews, last_review_page_url, known)
+                    yield from self.get_pool_reviews()
+                elif reviews_url:
+                    logger.info("Getting reviews for book %s: %s", book.id, book.title)
+                    logger.debug("Found reviews url: %s", reviews_url)
+                    # a browser blocked too often is replaced between books, when no reviews tab is open
+                    self.rotate_if_needed()
+                    yield from self.get_reviews_or_retry(
+                        (book.id, reviews_url, remaining_reviews, last_review_page_url, known))
+                    # books blocked earlier are tried again as soon as their backoff is over
+                    yield from self.get_blocked_reviews()
+                else:
+                    logger.info("No reviews for this book. Skipping...")
+                    yield self.checkpoint(self.finish_book, book.id)
+
+                num_books += 1
+                if num_books >= max_num_books:
                     # if we have met or are over our quota then stop
                     break
+            # the books on the page that other searches listed already
+            yield from self.listings.records()
         except NoSuchElementException as e:
-            print("Could not find any books: ", e)
+            logger.warning("Could not find any books: %s", e)
         except Exception as e:
-            print("Something went wrong while getting books: ", e)
-        finally:
-            return books, book_reviews
-
+            logger.warning("Something went wrong while getting books: %s", e)
+
+
+    def iter_page_books(self, query=None):
+        '''Yields the card of every book on the current page of results that is left to scrape, with its book, the
+        last page of reviews saved for it and whether it was started by a previous run. The books are recorded as
+        listed by the search named query'''
+        # wait until the book elements are in the page
+        self.wait_until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".sg-col-inner > .s-widget-container")))
+
+        for book_card in self.extract_book_cards():
+            # when resuming, books that were finished by a previous run are skipped and unfinished ones keep
+            # their ID and pick up from the last page of reviews that was saved. books another search listed are
+            # skipped too
+            started = start_listed_book(self.state, self.listings, book_card, self.new_book, query,
+                                        self.book_index)
+            if started is None:
+                logger.info("Already scraped %s. Skipping...", book_card["title"])
+                continue
+            book, last_review_page_url, resumed = started
+            yield book_card, book, last_review_page_url, resumed
+
+
+    def get_pool_reviews(self, wait=False):
+        '''Yields the reviews of the books the pool has finished, optionally waiting for every book still in the pool.
+        The workers finish in any order so books are passed on in book order to keep the review IDs deterministic'''
+        for book_id, reviews_fields in (self.review_pool.join() if wait else self.review_pool.collect()):
+            # the workers send back every page of a book at once
+            if reviews_fields is not None:
+                self.review_order.add_page(book_id, None, reviews_fields)
+            self.review_order.finish(book_id, reviews_fields is not None)
+        for book_id, pages, done in self.review_order.ready():
+            for page_url, reviews_fields in pages:
+                yield from self.review_records(book_id, reviews_fields, page_url)
+            if done:
+                yield self.checkpoint(self.finish_book, book_id)
+            # otherwise amazon kept blocking the book so it is left unfinished for a resumed run to try again
+
+
+    def get_reviews_or_retry(self, job):
+        '''Yields ("review", review) records for the reviews of a book. When amazon blocks its reviews, the book goes to
+        the retry queue to carry on from the last page saved, and it is finished otherwise'''
+        book_id, reviews_url, max_num_reviews, last_review_page_url, known = job
+        num_reviews = 0
+        try:
+            for page_url, reviews_fields in self.scrape_book_reviews(reviews_url, max_num_reviews,
+                                                                     last_review_page_url, known):
+                yield from self.review_records(book_id, reviews_fields, page_url)
+                last_review_page_url = page_url
+                num_reviews += len(reviews_fields)
+        except PageBlocked as blocked:
+            retry_job = (book_id, reviews_url, max_num_reviews - num_reviews, last_review_page_url, known)
+            delay = self.retries.push(book_id, retry_job)
+            if delay is None:
+                logger.error("%s, giving up on book %s for this run", blocked, book_id)
+            else:
+                logger.warning("%s, trying book %s again in %.0fs", blocked, book_id, delay)
+            return
+        yield self.checkpoint(self.finish_book, book_id)
+
+
+    def get_blocked_reviews(self, wait=False):
+        '''Yields ("review", review) records for the blocked books whose backoff is over, optionally waiting until
+        every blocked book was tried again'''
+        while len(self.retries):
+            jobs = self.retries.pop_ready()
+            if not jobs:
+                if not wait:
+                    return
+                with self.metrics.timer("backoff"):
+                    time.sleep(self.retries.wait_time() or 0)
+                continue
+            for job in jobs:
+                logger.info("Trying the reviews of book %s again", job[0])
+                self.rotate_if_needed()
+                yield from self.get_reviews_or_retry(job)
+
+
+    def iter_review_pages(self, reviews_url, max_num_reviews, last_review_page_url=None, known=None):
+        '''Scrapes the reviews of a book in a new tab like scrape_book_reviews, replacing the browser first if amazon
+        blocked it too often'''
+        self.rotate_if_needed()
+        yield from self.scrape_book_reviews(reviews_url, max_num_reviews, last_review_page_url, known)
+
+
+    def scrape_book_reviews(self, reviews_url, max_num_reviews, last_review_page_url=None, known=None):
+        '''Opens the reviews of a book in a new tab and yields the url and reviews of every page'''
+        resume = last_review_page_url is not None
+        # the tab with the page of books, which isn't always the first one, e.g. in a browser attached to with
+        # --debugger-address that already had tabs open
+        books_tab = self.driver.current_window_handle
+        try:
+            if resume:
+                # a previous run already saved the reviews up to this page so we continue from there
+                self.open_in_new_tab(last_review_page_url)
+                logger.debug("Resuming reviews in new tab...")
+            else:
+                # open reviews in a new tab
+                self.open_in_new_tab(reviews_url)
+                logger.debug("Opened in new tab...")
 
-    def get_book_reviews(self, book_id, max_num_reviews, initial_page=False):
+            for reviews_fields in self.collect_book_reviews(max_num_reviews, resume, known):
+                yield self.driver.current_url, reviews_fields
+        finally:
+            # close the reviews tab and go back to the page of books
+            if self.driver.current_window_handle != books_tab:
+                self.driver.close()
+            self.driver.switch_to.window(books_tab)
+
+
+    def collect_book_reviews(self, max_num_reviews, resume=False, known=None):
+        '''Scrapes the reviews of the book open in the current tab, yielding the reviews of every page. Reviews get
+        their IDs from review_records. When resuming, the current tab is the last page of reviews that was already
+        saved. When the fingerprints of the known reviews are given, the newest reviews are scraped first and we
+        stop at the first page that has nothing new'''
+        # scroll to the bottom of the page just in case there is lazy loaded content
+        self.scroll_to_bottom()
+
+        num_reviews = 0
+        if not resume:
+            # get all the reviews on the current page
+            reviews = self.get_book_reviews(max_num_reviews, initial_page=True, sort_recent=known is not None)
+            if known is not None and is_known_page(reviews, known):
+                logger.info("No new reviews for this book")
+                return
+            num_reviews += len(reviews)
+            yield reviews
+
+        while self.has_next_review_page() and num_reviews < max_num_reviews:
+            # while there is still another page of reviews and we haven't hit our limit yet...
+            logger.debug("Getting the next page of reviews...")
+
+            # navigate to the next review page. this waits until the old reviews are gone and for the rate limiter,
+            # which keeps us slow enough that amazon doesn't try to have us complete a captcha
+            self.go_to_next_review_page()
+
+            # scroll to the bottom again to make sure any lazy loaded content is definitely loaded in
+            self.scroll_to_bottom()
+
+            # grab all the reveiws on this page and pass them on
+            reviews = self.get_book_reviews(max_num_reviews, initial_page=False)
+            if known is not None and is_known_page(reviews, known):
+                logger.info("Reached the reviews scraped by an earlier crawl")
+                return
+            num_reviews += len(reviews)
+            yield reviews
+
+
+    def extract_reviews(self):
+        '''Extracts the fields of every review on the current page'''
+        return self.extract(parsers.parse_reviews, self.extract_reviews_with_selenium)
+
+
+    def extract_reviews_with_selenium(self):
+        '''Extracts the fields of every review on the current page one element at a time'''
+        reviews = []
+
+        # find all of the reviews on the page
+        review_elements = self.driver.find_elements(By.CSS_SELECTOR, "div.a-section.review")
+        for el in review_elements:
+            try:
+                # try to extract the title
+                logger.debug("Getting review title...")
+                title_el = el.find_element(By.CSS_SELECTOR, "a.review-title")
+                title = title_el.text
+            except NoSuchElementException:
+                # if we fail to find the title, then default to an empty string
+                logger.debug("Could not find review title")
+                title = ""
+
+            try:
+                # try to extract the date and location of the review
+                logger.debug("Getting review date and location...")
+                date_and_location_el = el.find_element(By.CSS_SELECTOR, "span.review-date")
+                date_and_location = date_and_location_el.get_attribute("innerHTML")
+
+                # date and location is usually separated by the word "on" so we split on that
+                location, date = date_and_location.split("on")
+
+                date = date.strip()
+
+                # in the string containing the location, the first 15 characters is irrelevant
+                # so we take the portion of the string after that
+                location = location[16:].strip()
+            except NoSuchElementException:
+                # if we fail to find the data and location, we default the values to empty strings
+                logger.debug("Could not find review date and location")
+                date = ""
+                location = ""
+
+            try:
+                # try to extract the review rating
+                logger.debug("Getting review rating...")
+                rating_el = el.find_element(By.CSS_SELECTOR, "span.a-icon-alt")
+
+                # do some preprocessing to get the rating as a float
+                rating = float(rating_el.get_attribute("innerHTML").split(" ")[0])
+            except NoSuchElementException:
+                # if we fail to find the rating then default it as None to show the absence of an entry
+                logger.debug("Could not find review rating")
+                rating = None
+
+            try:
+                # try to extract the body of the review
+                logger.debug("Getting review body...")
+                body_el = el.find_element(By.CSS_SELECTOR, "span.review-text-content > span")
+
+                # the rendered text has the tags stripped and the line breaks as new lines
+                body = body_el.get_attribute("innerText").strip()
+            except NoSuchElementException:
+                # if we fail to find the review body then default it as an empty string
+                logger.debug("Could not find review body")
+                body = ""
+
+            try:
+                # try to extract the number of helpful votes
+                logger.debug("Getting review helpful votes count...")
+                num_helpful_votes_el = el.find_element(By.CSS_SELECTOR, "span.cr-vote-text")
+                num_helpful_votes = num_helpful_votes_el.text.split(" ")[0]
+
+                # when there is only one vote Amazon uses the word "One" and when there is more
+                # than one Amazon uses actual digits so we handle the two cases here
+                if num_helpful_votes == "One":
+                    num_helpful_votes = 1
+                else:
+                    num_helpful_votes = int(num_helpful_votes.replace(",", ""))
+            except NoSuchElementException:
+                # if we fail to find the number of helpful votes then default it as None to show
+                # the absence of a value
+                logger.debug("Could not find review helpful votes")
+                num_helpful_votes = None
+
+            reviews.append(Review(title, location, date, rating, body, num_helpful_votes))
+        return reviews
+
+
+    def get_book_reviews(self, max_num_reviews, initial_page=False, sort_recent=False):
         '''Clicks on the review element and scrapes the reviews'''
+        reviews = []
         try:
-            reviews = []
             if initial_page:
                 # on the first page when getting reviews there is a "see all reviews" link. we wait for it and click it to access all the reviews
                 self.wait_until(EC.visibility_of_all_elements_located((By.CSS_SELECTOR, "div#cr-pagination-footer-0 > a, div#reviews-medley-footer > div.a-row > a")))
                 all_reviews_link = self.driver.find_element(By.CSS_SELECTOR, "div#cr-pagination-footer-0 > a, div#reviews-medley-footer > div.a-row > a")
-                print("Looking at all reviews...")
-                all_reviews_link.click()
-            
-            # wait for the reviews to become visible
-            self.wait_until(EC.visibility_of_all_elements_located((By.CSS_SELECTOR, "div.a-section.review")))
-            print("Reviews are visible...")
-
-            # once visible, find all of the reviews on the page
-            review_elements = self.driver.find_elements(By.CSS_SELECTOR, "div.a-section.review")
-            for el in review_elements:
-                try:
-                    # try to extract the title
-                    print("Getting review title...")
-                    title_el = el.find_element(By.CSS_SELECTOR, "a.review-title")
-                    title = title_el.text
-                except NoSuchElementException:
-                    # if we fail to find the title, then default to an empty string
-                    print("Could not find review title")
-                    title = ""
-                
-                try:
-                    # try to extract the date and location of the review
-                    print("Getting review date and location...")
-                    date_and_location_el = el.find_element(By.CSS_SELECTOR, "span.review-date")
-                    date_and_location = date_and_location_el.get_attribute("innerHTML")
-
-                    # date and location is usually separated by the word "on" so we split on that
-                    location, date = date_and_location.split("on")
-
-                    date = date.strip()
-
-                    # in the string containing the location, the first 15 characters is irrelevant
-                    # so we take the portion of the string after that
-                    location = location[16:].strip()
-                except NoSuchElementException:
-                    # if we fail to find the data and location, we default the values to empty strings
-                    print("Could not find review date and location")
-                    date = ""
-                    location = ""
-                
-                try:
-                    # try to extract the review rating
-                    print("Getting review rating...")
-                    rating_el = el.find_element(By.CSS_SELECTOR, "span.a-icon-alt")
-
-                    # do some preprocessing to get the rating as a float
-                    rating = float(rating_el.get_attribute("innerHTML").split(" ")[0])
-                except NoSuchElementException:
-                    # if we fail to find the rating then default it as None to show the absence of an entry
-                    print("Could not find review rating")
-                    rating = None
-
-                try:
-                    # try to extract the body of the review
-                    print("Getting review body...")
-                    body_el = el.find_element(By.CSS_SELECTOR, "span.review-text-content > span")
-                    body = body_el.get_attribute("innerHTML")
-                except NoSuchElementException:
-                    # if we fail to find the review body then default it as an empty string 
-                    print("Could not find review body")
-                    body = ""
-
-                try:
-                    # try to extract the number of helpful votes
-                    print("Getting review helpful votes count...")
-                    num_helpful_votes_el = el.find_element(By.CSS_SELECTOR, "span.cr-vote-text")
-                    num_helpful_votes = num_helpful_votes_el.text.split(" ")[0]
-                    
-                    # when there is only one vote Amazon uses the word "One" and when there is more
-                    # than one Amazon uses actual digits so we handle the two cases here
-                    if num_helpful_votes == "One":
-                        num_helpful_votes = 1
-                    else:
-                        num_helpful_votes = int(num_helpful_votes.replace(",", ""))
-                except NoSuchElementException:
-                    # if we fail to find the number of helpful votes then default it as None to show
-                    # the absence of a value
-                    print("Could not find review helpful votes")
-                    num_helpful_votes = None
-
-                review = {
-                    "id": AmazonBooksWebCrawler.next_review_id,
-                    "book_id": book_id,
-                    "title": title,
-                    "location": location,
-                    "reviewed_on": date,
-                    "rating": rating,
-                    "body": body,
-                    "num_helpful_votes": num_helpful_votes
-                }
+                logger.debug("Looking at all reviews...")
+                if sort_recent:
+                    # an incremental crawl reads the newest reviews first so it can stop at the first known ones
+                    self.load(set_query_params(all_reviews_link.get_attribute("href"), sortBy="recent"))
+                else:
+                    self.follow_link(all_reviews_link, "div.a-section.review")
+
+            # wait for the reviews to be in the page. we don't wait for all of them to be visible, checking that
+            # costs a round-trip per review and we read them from the page source anyway
+            self.wait_until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div.a-section.review")))
+            logger.debug("Reviews are loaded...")
+
+            # once visible, extract all of the reviews on the page
+            for review in self.extract_reviews():
                 reviews.append(review)
-                AmazonBooksWebCrawler.next_review_id += 1
                 if len(reviews) >= max_num_reviews:
                     # if we've reached or surpassed our limit of reviews to retrieve then we can stop
                     break
+        except PageBlocked:
+            # a captcha is not a page without reviews, the book is put in the retry queue by the caller
+            raise
         except NoSuchElementException as e:
-            print("Could not find any reviews: ", e)
+            logger.warning("Could not find any reviews: %s", e)
         except Exception as e:
-            print("Something went wrong while getting reviews: ", e)
-        finally:
-            return reviews
+            logger.warning("Something went wrong while getting reviews: %s", e)
+        return reviews
 
 
-if __name__ == '__main__':
-    # taken from selenium documentation. Basically sets up the browser engine automatically for you
-    service = ChromeService(executable_path=ChromeDriverManager().install())
+class AmazonBooksHttpCrawler(Crawler):
+    '''Scrapes the same books and reviews as AmazonBooksWebCrawler by fetching the pages directly without a browser'''
+    def __init__(self, fetcher=None, url=AMAZON_BOOKS_SEARCH_URL, rate_limiter=None, stats=None, state=None,
+                 review_index=None, metrics=None, retries=None, rotate_after=3, next_book_id=1, next_review_id=1,
+                 book_index=None):
+        # a new session is started after rotate_after blocks in a row
+        super().__init__(metrics, rate_limiter, retries, rotate_after, state, review_index, book_index, next_book_id,
+                         next_review_id)
+        self.fetcher = fetcher or HttpFetcher()
+        self.stats = stats or ThroughputCounter()
+        self.current_url, self.page_source = self.fetch_retrying(url) if url is not None else (None, None)
 
-    options = Options()
-    # uncomment the line below to run the crawler without opening a browser application on your computer
-    # options.add_argument("--headless")
-    driver = webdriver.Chrome(service=service, options=options)
 
-    crawler = AmazonBooksWebCrawler(driver)
+    def fetch(self, url):
+        '''Fetches a page once the rate limiter allows it. Safe to call from several threads'''
+        # a fresh page from the cache doesn't touch amazon so it doesn't wait for the rate limiter
+        requested = []
 
-    # create directories for the books and reviews
-    books_dir = os.path.join(os.getcwd(), "books")
-    if not os.path.exists(books_dir):
-        os.mkdir(books_dir)
+        def before_request():
+            requested.append(url)
+            self.wait_for_rate_limit()
+
+        try:
+            with self.metrics.timer("fetch"):
+                page = self.fetcher.get(url, before_request=before_request)
+        except PageBlocked as blocked:
+            self.page_blocked(blocked)
+            raise
+        self.stats.add(pages=1)
+        self.metrics.incr("pages")
+        if requested:
+            # only pages amazon actually served tell us whether we are going too fast
+            self.blocks.ok()
+            self.rate_limiter.speed_up()
+        return page
+
+
+    def fetch_retrying(self, url):
+        '''Fetches a page like fetch, waiting out a growing backoff and trying again while amazon blocks it. Used for
+        the search results, which the whole crawl depends on'''
+        attempt = 0
+        while True:
+            try:
+                return self.fetch(url)
+            except PageBlocked as blocked:
+                attempt += 1
+                if attempt > self.retries.max_attempts:
+                    raise
+                delay = self.retries.backoff(attempt)
+                logger.warning("%s, trying again in %.0fs", blocked, delay)
+                with self.metrics.timer("backoff"):
+                    time.sleep(delay)
+
+
+    def page_blocked(self, blocked):
+        '''Slows down after amazon blocked a page, and starts a new session when it keeps doing so'''
+        logger.warning("%s, slowing down to %.2f pages/s", blocked, self.rate_limiter.slow_down())
+        if self.blocks.blocked(blocked.kind):
+            logger.warning("Blocked too many times in a row, starting a new session")
+            self.fetcher.rotate_session()
 
-    reviews_dir = os.path.join(os.getcwd(), "reviews")
-    if not os.path.exists(reviews_dir):
-        os.mkdir(reviews_dir)
 
+    def go_to_next_book_page(self):
+        '''Moves to the next page if possible'''
+        try:
+            next_url = self.parse(parsers.parse_next_book_page_url, self.page_source, self.current_url)
+            if next_url is None:
+                return False
+            self.current_url, self.page_source = self.fetch_retrying(next_url)
+            return True
+        except Exception as e:
+            # handle any errors that might occur so the program doesn't stop
+            logger.warning("Something went wrong while navigating to the next page: %s", e)
+            return False
+
+
+    def review_page_url(self, all_reviews_url, page_number, sort_recent=False):
+        '''Returns the url of a given page of reviews by setting its pageNumber parameter, newest reviews first if
+        sort_recent is set'''
+        if sort_recent:
+            return set_query_params(all_reviews_url, sortBy="recent", pageNumber=page_number)
+        return set_query_params(all_reviews_url, pageNumber=page_number)
+
+
+    def new_book(self, book_card):
+        '''Turns the fields parsed from a book card into a book with the next book ID'''
+        self.stats.add(books=1)
+        return super().new_book(book_card)
+
+
+    def iter_page_books(self, query=None, page_source=None, page_url=None):
+        '''Yields the card of every book on a page of results (the current one by default) that is left to scrape,
+        with its book, the last page of reviews saved for it and whether it was started by a previous run. The books
+        are recorded as listed by the search named query'''
+        if page_source is None:
+            page_source, page_url = self.page_source, self.current_url
+        for book_card in self.parse(parsers.parse_books, page_source, page_url):
+            # when resuming, books finished by a previous run are skipped and unfinished ones carry on. books another
+            # search listed are skipped too
+            started = start_listed_book(self.state, self.listings, book_card, self.new_book, query,
+                                        self.book_index)
+            if started is None:
+                logger.info("Already scraped %s. Skipping...", book_card["title"])
+                continue
+            book, last_review_page_url, resumed = started
+            yield book_card, book, last_review_page_url, resumed
+
+
+    def iter_review_pages(self, reviews_url, max_num_reviews, last_review_page_url=None, known=None):
+        '''Fetches the reviews of a book page by page, yielding the url and the reviews of every page. When the
+        fingerprints of the known reviews are given, the newest reviews are fetched first and we stop at the first
+        page that has nothing new. The reviews of several books can be fetched from several threads at once'''
+        num_reviews = 0
+        if last_review_page_url is not None:
+            # a previous run already saved the reviews up to this page so we continue with the one after it
+            all_reviews_url = last_review_page_url
+            page_number = int(dict(parse_qsl(urlsplit(last_review_page_url).query)).get("pageNumber", 1)) + 1
+        else:
+            # the reviews link on a book card points at the product page so we follow its "see all reviews" link
+            product_url, product_page = self.fetch(reviews_url)
+            all_reviews_url = self.parse(parsers.parse_all_reviews_url, product_page, product_url)
+            if all_reviews_url is None:
+                logger.warning("Could not find the link to all reviews")
+                return
+            page_number = 1
+
+        while num_reviews < max_num_reviews:
+            page_url = self.review_page_url(all_reviews_url, page_number, sort_recent=known is not None)
+            final_url, page_source = self.fetch(page_url)
+            page_reviews = self.parse(parsers.parse_reviews, page_source)[:max_num_reviews - num_reviews]
+            if known is not None and is_known_page(page_reviews, known):
+                # reviews are newest first so the pages after this one were all scraped by an earlier crawl
+                logger.info("Reached the reviews scraped by an earlier crawl on page %s", page_number)
+                break
+            num_reviews += len(page_reviews)
+            self.stats.add(reviews=len(page_reviews))
+            yield page_url, page_reviews
+
+            if num_reviews >= max_num_reviews or not page_reviews:
+                break
+            if self.parse(parsers.parse_next_review_page_url, page_source, final_url) is None:
+                # no more pages of reviews for this book
+                break
+
+            logger.debug("Getting the next page of reviews...")
+            page_number += 1
+
+
+    def quit(self):
+        '''Ends the session for the crawler'''
+        self.fetcher.close()
+
+
+if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-nb", 
                         "--num-books", 
@@ -411,59 +1128,372 @@ if __name__ == '__main__':
                         help="Maximum number of reviews to scrape for each book (default: 500)",
                         type=int,
                         default=500)
+    parser.add_argument("--jobs",
+                        dest="jobs",
+                        help="JSON file listing the searches to crawl, each with its query or category, range of "
+                             "result pages and limits (default: the best sellers search)",
+                        default=None)
+    parser.add_argument("--query",
+                        dest="queries",
+                        help="Search query to crawl, can be given several times",
+                        action="append",
+                        default=[])
+    parser.add_argument("--category",
+                        dest="categories",
+                        help="ID of a category of books (an amazon browse node) to crawl, can be given several times",
+                        action="append",
+                        default=[])
+    parser.add_argument("--max-pages",
+                        dest="max_pages",
+                        help="Last page of results read for every --query and --category (default: all of them)",
+                        type=int,
+                        default=None)
+    parser.add_argument("--extraction",
+                        dest="extraction",
+                        help="How fields are extracted from a page: parse one snapshot of the page source or query "
+                             "selenium for every field (default: snapshot)",
+                        choices=["snapshot", "selenium"],
+                        default="snapshot")
+    parser.add_argument("--engine",
+                        dest="engine",
+                        help="Drive a real browser with selenium or fetch the pages directly over HTTP (default: selenium)",
+                        choices=["selenium", "http"],
+                        default="selenium")
+    parser.add_argument("--concurrency",
+                        dest="concurrency",
+                        help="Number of books whose reviews are fetched at the same time by the http engine (default: 4)",
+                        type=int,
+                        default=4)
+    parser.add_argument("--rate",
+                        dest="rate",
+                        help="Maximum number of pages per second requested by the crawler, or by each review worker "
+                             "(default: 1.0)",
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--min-rate",
+                        dest="min_rate",
+                        help="Number of pages per second the crawler slows down to at most when amazon keeps serving "
+                             "robot checks. It speeds back up to --rate once pages go through again (default: 0.05)",
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--jitter",
+                        dest="jitter",
+                        help="Maximum random delay in seconds added before every request (default: 0.5)",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--wait-timeout",
+                        dest="wait_timeout",
+                        help="Seconds the selenium engine waits for a page to be ready before giving up on it "
+                             "(default: 10)",
+                        type=float,
+                        default=10)
+    parser.add_argument("--block-retries",
+                        dest="block_retries",
+                        help="Number of times a book or search page blocked by a captcha, robot check or throttling "
+                             "is tried again before it is left for a resumed run (default: 5)",
+                        type=int,
+                        default=5)
+    parser.add_argument("--block-backoff",
+                        dest="block_backoff",
+                        help="Seconds before the first retry of a blocked page, doubling with every retry up to 15 "
+                             "minutes (default: 30)",
+                        type=float,
+                        default=30)
+    parser.add_argument("--rotate-after",
+                        dest="rotate_after",
+                        help="Number of blocked pages in a row after which the session (cookies, user agent and "
+                             "browser) is replaced (default: 3)",
+                        type=int,
+                        default=3)
+    parser.add_argument("--cache-dir",
+                        dest="cache_dir",
+                        help="Directory where the http engine keeps the pages it fetched, so a re-crawl only downloads "
+                             "pages that changed (default: no cache)",
+                        default=None)
+    parser.add_argument("--max-cache-mb",
+                        dest="max_cache_mb",
+                        help="Size above which the least recently used cached pages are evicted (default: 500)",
+                        type=float,
+                        default=500)
+    parser.add_argument("--cache-ttl",
+                        dest="cache_ttl",
+                        help="Hours a cached page is used without asking amazon whether it changed (default: 24)",
+                        type=float,
+                        default=24)
+    parser.add_argument("--workers",
+                        dest="workers",
+                        help="Number of headless Chrome processes scraping reviews in parallel for the selenium engine. "
+                             "With 0 the reviews are scraped in a tab of the main browser (default: 0)",
+                        type=int,
+                        default=0)
+    parser.add_argument("--headless",
+                        dest="headless",
+                        help="Run the main browser without opening a window, --no-headless to watch it (default: on)",
+                        action=BooleanOptionalAction,
+                        default=True)
+    parser.add_argument("--block-resources",
+                        dest="block_resources",
+                        help="Don't load images, stylesheets and fonts in the browsers, which the scraping doesn't "
+                             "need (default: on)",
+                        action=BooleanOptionalAction,
+                        default=True)
+    parser.add_argument("--driver-path",
+                        dest="driver_path",
+                        help="chromedriver to use for the selenium engine (default: the one resolved last time, or "
+                             "resolved by webdriver_manager when Chrome changed version)",
+                        default=None)
+    parser.add_argument("--profile-dir",
+                        dest="profile_dir",
+                        help="Chrome profile directory of the main browser, kept between runs so it starts with a warm "
+                             "cache and its cookies",
+                        default=None)
+    parser.add_argument("--debugger-address",
+                        dest="debugger_address",
+                        help="host:port of a Chrome already running with --remote-debugging-port, used as the main "
+                             "browser instead of starting one",
+                        default=None)
+    parser.add_argument("--output-format",
+                        dest="output_formats",
+                        help="Formats the books and reviews are written in, as they are scraped (default: csv)",
+                        nargs="+",
+                        choices=["csv", "jsonl", "parquet"],
+                        default=["csv"])
+    parser.add_argument("--single-reviews-file",
+                        dest="single_reviews_file",
+                        help="Write the reviews of every book to one reviews/reviews.csv instead of one file per book",
+                        action="store_true")
+    parser.add_argument("--state",
+                        dest="state",
+                        help="SQLite file where the progress of the crawl is checkpointed (default: crawl_state.db)",
+                        default="crawl_state.db")
+    parser.add_argument("--resume",
+                        dest="resume",
+                        help="Continue the crawl checkpointed in the state file instead of starting over",
+                        action="store_true")
+    parser.add_argument("--incremental",
+                        dest="incremental",
+                        help="Read every book's reviews newest first, stop at the first page scraped by an earlier "
+                             "crawl and only write the new reviews",
+                        action="store_true")
+    parser.add_argument("--review-index",
+                        dest="review_index",
+                        help="SQLite file remembering the reviews scraped by every crawl, used by --incremental "
+                             "(default: review_index.db)",
+                        default="review_index.db")
+    parser.add_argument("--book-index",
+                        dest="book_index",
+                        help="SQLite file remembering the books scraped by every crawl, so books keep their ID across "
+                             "crawls and books scraped recently are skipped",
+                        default=None)
+    parser.add_argument("--refresh-after",
+                        dest="refresh_after",
+                        help="Hours after which a book in the --book-index is scraped again (default: 24)",
+                        type=float,
+                        default=24)
+    parser.add_argument("--log-level",
+                        dest="log_level",
+                        help="Least severe messages shown: DEBUG also shows every field being scraped (default: INFO)",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        default="INFO")
+    parser.add_argument("--progress-interval",
+                        dest="progress_interval",
+                        help="Seconds between progress lines with the throughput and ETA, 0 to turn them off "
+                             "(default: 30)",
+                        type=float,
+                        default=30)
+    parser.add_argument("--metrics-file",
+                        dest="metrics_file",
+                        help="File the counters and per-stage latency histograms are written to at the end of the run",
+                        default=None)
+    parser.add_argument("--metrics-format",
+                        dest="metrics_format",
+                        help="Format of the metrics file (default: json)",
+                        choices=["json", "prometheus"],
+                        default="json")
 
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    # counters and stage timings of the whole run, including the pool workers
+    metrics = Metrics()
+
+    # every book and page of reviews is checkpointed as it is scraped so an interrupted crawl can be resumed
+    state = CrawlState(args.state, resume=args.resume)
+    url = state.get_meta("frontier_url", AMAZON_BOOKS_SEARCH_URL)
+    state.set_meta("frontier_url", url)
+    next_book_id = state.get_meta("next_book_id", 1)
+    next_review_id = state.get_meta("next_review_id", 1)
+    if args.resume:
+        logger.info("Resuming from %s with %s books already scraped...", url, state.count_books())
+
+    # several searches are crawled one after the other by the selenium engine and at the same time by the http engine
+    searches = load_jobs(args.jobs) if args.jobs is not None else []
+    searches += [SearchJob(query=query, last_page=args.max_pages) for query in args.queries]
+    searches += [SearchJob(category=category, last_page=args.max_pages) for category in args.categories]
+    if len({search.name for search in searches}) < len(searches):
+        parser.error("Every search needs a different name")
+    for search in searches:
+        # a resumed crawl carries on with every search from the page it got to, and skips the searches it finished
+        search.frontier_url = state.get_meta(search.frontier_key)
+    searches = [search for search in searches if not state.get_meta(search.done_key, False)]
+    if searches:
+        # the crawlers open the first page of every search themselves
+        url = None
+
+    review_pool = None
+    page_cache = None
+    # reviews keep the IDs they got in the crawl that first found them
+    review_index = ReviewIndex(args.review_index) if args.incremental else None
+    # books keep the IDs they got in the crawl that first found them, and the ones scraped recently are only looked up
+    book_index = None
+    if args.book_index is not None:
+        book_index = BookIndex(args.book_index, refresh_after=args.refresh_after * 60 * 60)
+    # the rate slows down when amazon serves a robot check and works its way back up to --rate
+    rate_limits = {"rate": args.rate, "jitter": args.jitter, "min_rate": args.min_rate, "max_rate": args.rate}
+    # pages amazon blocks are tried again later, with a longer wait every time
+    retries = RetryQueue(base_delay=args.block_backoff, max_attempts=args.block_retries)
+    if args.engine == "http":
+        rate_limiter = RateLimiter(**rate_limits)
+        if args.cache_dir is not None:
+            page_cache = PageCache(args.cache_dir, max_bytes=int(args.max_cache_mb * 1024 * 1024),
+                                   ttl=args.cache_ttl * 60 * 60)
+        # one connection for each review worker and one for the search results
+        crawler = AmazonBooksHttpCrawler(HttpFetcher(pool_size=args.concurrency + 1, cache=page_cache), url=url,
+                                         rate_limiter=rate_limiter, state=state, review_index=review_index,
+                                         metrics=metrics, retries=retries, rotate_after=args.rotate_after,
+                                         next_book_id=next_book_id, next_review_id=next_review_id,
+                                         book_index=book_index)
+    else:
+        # resolve the driver once so the workers don't all look it up again
+        with metrics.timer("resolve_driver"):
+            driver_path = args.driver_path or resolve_driver_path()
+        if args.workers > 0:
+            review_pool = CrawlerPool(args.workers, driver_path=driver_path, extraction=args.extraction,
+                                      metrics=metrics, log_level=args.log_level, rate_limits=rate_limits,
+                                      wait_timeout=args.wait_timeout, retries=retries,
+                                      rotate_after=args.rotate_after, block_resources=args.block_resources)
+
+        def new_driver():
+            '''Starts the browser replacing one amazon blocked too often, with a different user agent. It gets a
+            fresh profile so it doesn't carry the cookies amazon blocked'''
+            return create_chrome_driver(driver_path, headless=args.headless, user_agent=next_user_agent(),
+                                        block_resources=args.block_resources)
+
+        with metrics.timer("start_browser"):
+            driver = create_chrome_driver(driver_path, headless=args.headless, profile_dir=args.profile_dir,
+                                          block_resources=args.block_resources,
+                                          debugger_address=args.debugger_address)
+        crawler = AmazonBooksWebCrawler(driver, extraction=args.extraction, url=url, review_pool=review_pool,
+                                        state=state, review_index=review_index,
+                                        rate_limiter=RateLimiter(**rate_limits), wait_timeout=args.wait_timeout,
+                                        metrics=metrics, retries=retries, driver_factory=new_driver,
+                                        rotate_after=args.rotate_after, next_book_id=next_book_id,
+                                        next_review_id=next_review_id, book_index=book_index)
+    # short scheduled crawls spend a good share of their time starting up, so we keep an eye on it
+    startup = time.monotonic() - metrics.started_at
+    metrics.observe("startup", startup)
+    logger.info("Ready to crawl after %.2fs", startup)
 
-    max_num_books = args.num_books
-    max_num_reviews = args.num_reviews
-
-    books, book_reviews = crawler.get_books_and_reviews(max_num_books, max_num_reviews)
-    while crawler.has_next_book_page() and len(books) < max_num_books:
-        # while books remain and we haven't hit our quota...
-
-        # navigate tot he next page of books
-        crawler.go_to_next_book_page()
-
-        print("Going to next page...")
-
-        # wait for the page to load and also slow down so Amazon doesn't
-        # make us solve a captcha
-        time.sleep(3)
-
-        # scroll to the bottom of the page to make sure everything is lazy loaded in
-        crawler.scroll_to_bottom()
-
-        # get all the books and reviews from the page
-        page_books, page_book_reviews = crawler.get_books_and_reviews(max_num_books, max_num_reviews)
-
-        # add to the collection of books and reviews already retrieved
-        books += page_books
-        book_reviews |= page_book_reviews # merge the dictionaries
+    # create directories for the books and reviews
+    books_dir = os.path.join(os.getcwd(), "books")
+    if not os.path.exists(books_dir):
+        os.mkdir(books_dir)
 
-    # write the books and reviews to files
-    print("Writing books to file...")
-    with open(f'{books_dir}/books.csv', 'w') as books_csv:  
-        writer = csv.writer(books_csv)
-        header = books[0].keys()
-        writer.writerow(header)
-        for book in books:
-            writer.writerow(book.values())
+    reviews_dir = os.path.join(os.getcwd(), "reviews")
+    if not os.path.exists(reviews_dir):
+        os.mkdir(reviews_dir)
 
-    for book in books:
-        try:
-            reviews = book_reviews[book["id"]]
-        
-            if reviews:
-                print("Writing reviews to file...")
-                with open(f'{reviews_dir}/book_{book["id"]}_reviews.csv', 'w') as reviews_csv:
-                    writer = csv.writer(reviews_csv)
-                    header = reviews[0].keys()
-                    writer.writerow(header)
-                    for review in reviews:
-                        writer.writerow(review.values())
-        except Exception as e:
-            print("Something went wrong while writing reviews", e)
-            print("Trying next book's reviews...")
-            continue
+    max_num_books = args.num_books
+    max_num_reviews = args.num_reviews
 
-    crawler.quit()
+    # books and reviews are written as soon as they are scraped. a resumed crawl adds to the files of the
+    # interrupted one
+    sinks = []
+    if "csv" in args.output_formats:
+        sinks.append(CsvSink(books_dir, reviews_dir, single_reviews_file=args.single_reviews_file, append=args.resume))
+    if "jsonl" in args.output_formats:
+        sinks.append(JsonLinesSink(books_dir, reviews_dir, append=args.resume))
+    if "parquet" in args.output_formats:
+        # pyarrow is only needed when writing parquet so it is imported here
+        from columnar import ParquetSink
+        sinks.append(ParquetSink(os.path.join(books_dir, "books.parquet"), os.path.join(reviews_dir, "reviews.parquet"),
+                                 append=args.resume))
+
+    def write_records(records):
+        '''Passes every scraped record on to the sinks'''
+        for kind, record in records:
+            if kind == "checkpoint":
+                # the crawl's progress is saved once every sink has the records before it on disk
+                checkpoint = shared_checkpoint(record, len(sinks))
+                for sink in sinks:
+                    sink.write(kind, checkpoint)
+                continue
+            metrics.incr({"book": "books", "review": "reviews"}.get(kind, "book_queries"))
+            with metrics.timer("write"):
+                for sink in sinks:
+                    sink.write(kind, record)
+
+    progress = None
+    if args.progress_interval > 0:
+        progress = ProgressReporter(metrics, max_num_books, args.progress_interval).start()
+
+    try:
+        if args.engine == "http":
+            # the http engine fetches the reviews of several books at once while it pages through the search results
+            # books finished before resuming count towards the quota, unfinished ones are picked up again
+            write_records(AsyncCrawlScheduler(crawler, args.concurrency).run(
+                max_num_books - state.count_books(finished_only=True), max_num_reviews, searches or None))
+            logger.info(crawler.stats.report())
+            if page_cache is not None:
+                logger.info(page_cache.report())
+        else:
+            # books a resumed run left unfinished were listed before the page it got to, so they are finished first.
+            # they count towards the quota
+            write_records(crawler.get_books_and_reviews(max_num_books, max_num_reviews,
+                                                        books=crawler.iter_unfinished_books()))
+            if searches:
+                write_records(crawler.crawl_searches(searches, max_num_books - state.count_books(), max_num_reviews))
+            else:
+                if state.count_books() < max_num_books:
+                    write_records(crawler.get_books_and_reviews(max_num_books - state.count_books(), max_num_reviews))
+                while crawler.has_next_book_page() and state.count_books() < max_num_books:
+                    # while books remain and we haven't hit our quota...
+
+                    # navigate tot he next page of books. this waits until the old books are gone and for the rate
+                    # limiter, which slows us down so Amazon doesn't make us solve a captcha
+                    if not crawler.go_to_next_book_page():
+                        break
+
+                    logger.info("Going to next page...")
+                    state.set_meta("frontier_url", crawler.driver.current_url)
+
+                    # scroll to the bottom of the page to make sure everything is lazy loaded in
+                    crawler.scroll_to_bottom()
+
+                    # get all the books and reviews from the page
+                    write_records(crawler.get_books_and_reviews(max_num_books - state.count_books(), max_num_reviews))
+
+            if review_pool is not None:
+                # wait for the workers to finish and write the reviews they still had
+                write_records(crawler.get_pool_reviews(wait=True))
+            # books amazon blocked are tried again once their backoff is over
+            write_records(crawler.get_blocked_reviews(wait=True))
+    finally:
+        if progress is not None:
+            progress.stop()
+        for sink in sinks:
+            sink.close()
+        crawler.quit()
+        if review_pool is not None:
+            review_pool.close()
+        if page_cache is not None:
+            page_cache.close()
+        if review_index is not None:
+            review_index.close()
+        if book_index is not None:
+            book_index.close()
+        state.close()
+
+        logger.info(crawler.blocks.report())
+        logger.info("End of run report:\n%s", metrics.report())
+        if args.metrics_file is not None:
+            metrics.dump(args.metrics_file, args.metrics_format)